@@ -0,0 +1,124 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import logging
+
+from . import util, runtime
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# The circuit breaker protects against outages of the Ravello API. Without
+# it, every proxy invocation would wait out the connect and read timeouts,
+# including the transport level retries, inside retry loops of up to 20
+# minutes. That piles up hung Ironic conductor threads.
+#
+# The breaker is shared by all ravstack processes of the same user, through
+# a file in the runtime directory. It has three states:
+#
+#  - closed: requests are made normally. Connection failures and timeouts are
+#    counted. After `threshold` of them within `window` seconds, the breaker
+#    opens.
+#  - open: requests fail immediately, for `cooldown` seconds.
+#  - half-open: after the cooldown a single probe request is let through. If
+#    it succeeds the breaker closes, otherwise it opens again.
+
+
+class CircuitOpen(RuntimeError):
+    """Raised when a request is not made because the breaker is open."""
+
+
+def get_breaker_name():
+    """Return the name of the breaker state file, or ``None``."""
+    rtdir = runtime.get_runtime_dir()
+    if rtdir:
+        return os.path.join(rtdir, 'breaker.json')
+
+
+class CircuitBreaker(object):
+    """A circuit breaker for the API."""
+
+    # A probe that takes longer than this is assumed to have been abandoned.
+    probe_timeout = 120
+
+    def __init__(self, fname, threshold, window, cooldown):
+        self.fname = fname
+        self.threshold = threshold
+        self.window = window
+        self.cooldown = cooldown
+
+    def _write(self, state):
+        util.write_file_atomic(self.fname, json.dumps(state))
+
+    def check(self):
+        """Check if a request may be made. Raise :class:`CircuitOpen` if not."""
+        state = util.read_json_file(self.fname, {})
+        if state.get('state', 'closed') == 'closed':
+            return
+        with util.lock_file(self.fname + '.lock'):
+            state = util.read_json_file(self.fname, {})
+            now = time.time()
+            if state.get('state', 'closed') == 'closed':
+                return
+            elif state['state'] == 'open' and now >= state['opened'] + self.cooldown \
+                        or state['state'] == 'half-open' \
+                            and now >= state['probe'] + self.probe_timeout:
+                LOG.info('Circuit breaker half-open, letting a probe request through.')
+                state.update(state='half-open', probe=now)
+                self._write(state)
+                return
+            remaining = max(0, state['opened'] + self.cooldown - now)
+        METRICS.increment('breaker_rejected')
+        raise CircuitOpen('Ravello API unavailable after {} failures; failing fast '
+                          'for another {:.0f} seconds.'.format(state['failures'], remaining))
+
+    def record_success(self):
+        """Record a successful request."""
+        state = util.read_json_file(self.fname, {})
+        if not state or state == {'state': 'closed', 'failures': 0}:
+            return
+        with util.lock_file(self.fname + '.lock'):
+            state = util.read_json_file(self.fname, {})
+            if state.get('state', 'closed') != 'closed':
+                LOG.info('Circuit breaker closed, Ravello API is available again.')
+            self._write({'state': 'closed', 'failures': 0})
+
+    def record_failure(self, error):
+        """Record a failed request, with exception *error*."""
+        with util.lock_file(self.fname + '.lock'):
+            state = util.read_json_file(self.fname, {})
+            now = time.time()
+            if state.get('state', 'closed') == 'closed':
+                if now - state.get('first', 0) > self.window:
+                    state.update(first=now, failures=0)
+                state['failures'] = state.get('failures', 0) + 1
+                if state['failures'] < self.threshold:
+                    self._write(dict(state, state='closed'))
+                    return
+            elif state['state'] == 'open':
+                return
+            state.update(state='open', opened=now)
+            self._write(state)
+        METRICS.increment('breaker_opened')
+        LOG.error('Circuit breaker opened for {} seconds after {!s}'.format(self.cooldown, error))
+
+    def get_status(self):
+        """Return a one line description of the breaker state."""
+        state = util.read_json_file(self.fname, {})
+        status = state.get('state', 'closed')
+        if status == 'open':
+            remaining = max(0, state['opened'] + self.cooldown - time.time())
+            status += ' (probe in {:.0f} seconds)'.format(remaining)
+        elif status == 'closed' and state.get('failures'):
+            status += ' ({} recent failures)'.format(state['failures'])
+        return status
@@ -0,0 +1,243 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import hashlib
+import logging
+import contextlib
+
+from . import util
+
+LOG = logging.getLogger(__name__)
+
+# The caches in this module are stored as files in the per-user runtime
+# directory. They are shared between all ravstack processes of the same user,
+# and use file locks to coordinate updates.
+
+
+class SessionCache(object):
+    """A cache of Ravello API sessions.
+
+    Sessions are keyed by the API URL and the user name. Each session is a
+    dictionary with the session cookies and the user info returned by the
+    login call.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lockname = filename + '.lock'
+
+    def lock(self):
+        """Return a context manager that locks the cache."""
+        return util.lock_file(self.lockname)
+
+    def load(self, key):
+        """Return the session for *key*, or ``None``."""
+        sessions = util.read_json_file(self.filename, {})
+        return sessions.get(key)
+
+    def save(self, key, session):
+        """Store the session for *key*. The cache must be locked."""
+        sessions = util.read_json_file(self.filename, {})
+        session = dict(session, time=time.time())
+        sessions[key] = session
+        util.write_file_atomic(self.filename, json.dumps(sessions, sort_keys=True))
+
+    def remove(self, key):
+        """Remove the session for *key*. The cache must be locked."""
+        sessions = util.read_json_file(self.filename, {})
+        if sessions.pop(key, None) is not None:
+            util.write_file_atomic(self.filename, json.dumps(sessions, sort_keys=True))
+
+
+class SnapshotCache(object):
+    """A cache of application snapshots.
+
+    The cache also stores the mapping of application names to IDs, so that
+    an application can be loaded without first searching for it.
+    """
+
+    def __init__(self, dirname, url):
+        self.dirname = dirname
+        self.url = url
+
+    def _filename(self, template, *args):
+        return os.path.join(self.dirname, template.format(*args))
+
+    def get_id(self, name):
+        """Return the ID of the application *name*, or ``None``."""
+        names = util.read_json_file(self._filename('apps.json'), {})
+        return names.get('{} {}'.format(self.url, name))
+
+    def set_id(self, name, appid):
+        """Store the ID of the application *name*. Pass ``None`` for *appid* to
+        remove the mapping."""
+        fname = self._filename('apps.json')
+        with util.lock_file(fname + '.lock'):
+            names = util.read_json_file(fname, {})
+            key = '{} {}'.format(self.url, name)
+            if appid is None:
+                names.pop(key, None)
+            else:
+                names[key] = appid
+            util.write_file_atomic(fname, json.dumps(names, sort_keys=True))
+
+    def load(self, appid, max_age):
+        """Return the application *appid* if a snapshot of it exists that is
+        not older than *max_age* seconds, or ``None`` otherwise."""
+        data = util.read_json_file(self._filename('app-{}.json', appid), {})
+        if data.get('url') != self.url or 'application' not in data:
+            return
+        age = time.time() - data['time']
+        if age > max_age:
+            return
+        LOG.debug('Using cached application (age {:.2f} seconds).'.format(age))
+        return data['application']
+
+    def save(self, appid, app, fetched):
+        """Store a snapshot of application *appid*.
+
+        The *fetched* argument is the time at which the request to fetch the
+        application was started. The snapshot is not stored if a newer
+        snapshot exists, or the application was changed after that time.
+        """
+        fname = self._filename('app-{}.json', appid)
+        with util.lock_file(fname + '.lock'):
+            data = util.read_json_file(fname, {})
+            if data.get('url') == self.url and \
+                        max(data.get('time', 0), data.get('invalidated', 0)) >= fetched:
+                return
+            invalidated = data.get('invalidated', 0) if data.get('url') == self.url else 0
+            data = {'url': self.url, 'time': fetched, 'application': app,
+                    'invalidated': invalidated}
+            util.write_file_atomic(fname, json.dumps(data))
+
+    def load_index(self, appid):
+        """Return the index of application *appid*, or ``None``.
+
+        The index is a dictionary with the VM IDs by name under "vms", and
+        the "nextStopTime" of the application. It is used to access VMs
+        without loading the application.
+        """
+        data = util.read_json_file(self._filename('index-{}.json', appid), {})
+        if data.get('url') != self.url:
+            return
+        return data
+
+    def save_index(self, appid, vms, next_stop):
+        """Store the index of application *appid*."""
+        data = {'url': self.url, 'vms': vms, 'nextStopTime': next_stop}
+        util.write_file_atomic(self._filename('index-{}.json', appid),
+                               json.dumps(data, sort_keys=True))
+
+    def get_invalidated(self, appid):
+        """Return the last time application *appid* was invalidated."""
+        data = util.read_json_file(self._filename('app-{}.json', appid), {})
+        return data.get('invalidated', 0) if data.get('url') == self.url else 0
+
+    def invalidate(self, appid):
+        """Invalidate the snapshot of application *appid*."""
+        fname = self._filename('app-{}.json', appid)
+        with util.lock_file(fname + '.lock'):
+            data = {'url': self.url, 'invalidated': time.time()}
+            util.write_file_atomic(fname, json.dumps(data))
+
+
+class RequestCache(object):
+    """A short lived cache of GET results, used to collapse identical
+    concurrent requests made by different processes.
+
+    The first process to make a request does so under a lock for its URL. A
+    process that has to wait for the lock leaves a marker, and only then is
+    the result stored. Waiting processes reuse the result if it completed at
+    most *window* seconds before they wanted to make the same request.
+    Results are removed once they are older than the window, and a lock file
+    is removed when it is released and nobody is waiting for it.
+    """
+
+    # Wait markers and lock files older than this were abandoned.
+    marker_max_age = 300
+
+    def __init__(self, dirname, url, window):
+        self.dirname = dirname
+        self.url = url
+        self.window = window
+
+    def _filename(self, url, suffix='json'):
+        digest = hashlib.sha1((self.url + url).encode('utf-8')).hexdigest()
+        return os.path.join(self.dirname, 'get-{}.{}'.format(digest[:16], suffix))
+
+    @contextlib.contextmanager
+    def lock(self, url):
+        """Context manager that locks the request for *url*."""
+        fname = self._filename(url, 'lock')
+        marker = self._filename(url, 'wait')
+        while True:
+            with util.lock_file(fname, on_wait=lambda: util.create_file(marker)) as fd:
+                # The lock file may have been removed by the previous holder
+                # while we were waiting for it. Then lock the new one.
+                st = util.try_stat(fname)
+                fst = os.fstat(fd)
+                if st is None or (st.st_dev, st.st_ino) != (fst.st_dev, fst.st_ino):
+                    continue
+                try:
+                    yield
+                finally:
+                    if util.try_stat(marker) is None:
+                        util.try_unlink(fname)
+                return
+
+    def load(self, url, wanted, not_before=0):
+        """Return the result for *url* as a ``{'result': result}`` dictionary,
+        or ``None``. The result must have completed at most `window` seconds
+        before *wanted*, and its request must have started after
+        *not_before*. The lock must be held."""
+        fname = self._filename(url)
+        data = util.read_json_file(fname, {})
+        if not data:
+            return
+        elif data['done'] < time.time() - self.window:
+            util.try_unlink(fname)
+            return
+        elif data.get('url') != self.url + url or data['done'] < wanted - self.window \
+                    or data['time'] <= not_before:
+            return
+        return data
+
+    def save(self, url, result, started):
+        """Store the result for *url*, if another process is waiting for it.
+        The lock must be held."""
+        marker = self._filename(url, 'wait')
+        if util.try_stat(marker) is None:
+            return
+        data = {'url': self.url + url, 'time': started, 'done': time.time(),
+                'result': result}
+        util.write_file_atomic(self._filename(url), json.dumps(data))
+        util.try_unlink(marker)
+        self._prune()
+
+    def _prune(self):
+        """Remove expired results and abandoned wait markers."""
+        now = time.time()
+        for name in os.listdir(self.dirname):
+            if not name.startswith('get-'):
+                continue
+            elif name.endswith('.json'):
+                max_age = self.window
+            elif name.endswith(('.wait', '.lock')):
+                max_age = self.marker_max_age
+            else:
+                continue
+            fname = os.path.join(self.dirname, name)
+            st = util.try_stat(fname)
+            if st is not None and now - st.st_mtime > max_age:
+                util.try_unlink(fname)
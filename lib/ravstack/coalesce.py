@@ -0,0 +1,142 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import random
+import logging
+
+from . import util, trace
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# A change queue coalesces changes to an application that are submitted at
+# about the same time by different processes, or by different threads in the
+# proxy daemon. This is a "group commit":
+#
+#  - A change is added to the queue, which is a file in the runtime directory.
+#  - The submitter takes the apply lock. While another batch is being applied
+#    this blocks, and changes from other submitters accumulate in the queue.
+#    A lone submitter does not wait. Optionally, the submitter first waits
+#    until a fixed window after the oldest pending change was queued.
+#  - If the change was applied by someone else in the meantime, the result is
+#    picked up from the results file. Otherwise the submitter becomes the
+#    leader: it takes all pending changes off the queue, applies them in one
+#    go, and stores the results for the other submitters.
+#
+# Changes of submitters that went away before their change was applied are
+# dropped from the queue.
+
+
+def new_id():
+    """Return a unique ID for a change."""
+    return '{}-{:016x}'.format(os.getpid(), random.getrandbits(64))
+
+
+class ChangeQueue(object):
+    """A queue of changes to be applied in batches."""
+
+    # How long results are kept for submitters that went away.
+    results_max_age = 300
+
+    def __init__(self, dirname, name):
+        self.queue_file = os.path.join(dirname, '{}-queue.json'.format(name))
+        self.results_file = os.path.join(dirname, '{}-results.json'.format(name))
+        self.apply_lock = os.path.join(dirname, '{}.lock'.format(name))
+
+    def _read_queue(self):
+        """Read the queue, without the changes of submitters that are gone.
+        The queue lock must be held."""
+        queue = util.read_json_file(self.queue_file, [])
+        live = [c for c in queue if c.get('pid') and util.pid_exists(c['pid'])]
+        if len(live) < len(queue):
+            LOG.debug('Dropped {} stale change(s) from the queue.'.format(len(queue) - len(live)))
+        return live
+
+    def _add(self, change):
+        """Add a change to the queue. Return the time at which the oldest
+        pending change for the same key was queued."""
+        with util.lock_file(self.queue_file + '.lock'):
+            queue = self._read_queue()
+            queue.append(change)
+            util.write_file_atomic(self.queue_file, json.dumps(queue))
+        return min(c['time'] for c in queue if c['key'] == change['key'])
+
+    def _take_pending(self, key):
+        """Remove and return all pending changes for *key*."""
+        with util.lock_file(self.queue_file + '.lock'):
+            queue = self._read_queue()
+            pending = [c for c in queue if c['key'] == key]
+            queue = [c for c in queue if c['key'] != key]
+            util.write_file_atomic(self.queue_file, json.dumps(queue))
+        return pending
+
+    def _take_result(self, change_id):
+        """Remove and return the result for change *change_id*, if any. The
+        apply lock must be held."""
+        results = util.read_json_file(self.results_file, {})
+        result = results.pop(change_id, None)
+        if result is not None:
+            util.write_file_atomic(self.results_file, json.dumps(results))
+        return result
+
+    def _store_results(self, new_results):
+        """Store results for other submitters. The apply lock must be held."""
+        results = util.read_json_file(self.results_file, {})
+        now = time.time()
+        results = {k: v for k, v in results.items()
+                   if now - v['time'] < self.results_max_age}
+        results.update(new_results)
+        util.write_file_atomic(self.results_file, json.dumps(results))
+
+    def submit(self, key, change, apply, window):
+        """Submit *change* for *key* and wait until it has been applied.
+
+        The *apply* function is called with a list of pending changes if this
+        submitter becomes the leader. It must return a dictionary mapping the
+        change IDs to an error message, or to ``None`` for success. A
+        :class:`RuntimeError` is raised if the change failed.
+
+        If *window* is positive, the batch is kept open for that many seconds
+        after the oldest pending change was queued.
+        """
+        change = dict(change, id=new_id(), key=key, pid=os.getpid(), time=time.time())
+        with trace.span('coalesce', key=key) as sp:
+            oldest = self._add(change)
+            delay = oldest + window - time.time()
+            if window > 0 and delay > 0:
+                time.sleep(delay)
+            with util.lock_file(self.apply_lock):
+                result = self._take_result(change['id'])
+                if result is None:
+                    pending = self._take_pending(key)
+                    if change['id'] not in [c['id'] for c in pending]:
+                        raise RuntimeError('Change was lost by another process.')
+                    sp.set(leader=True, batch=len(pending))
+                    LOG.debug('Applying batch of {} change{}.'
+                                .format(len(pending), 's' if len(pending) > 1 else ''))
+                    METRICS.increment('change_batches')
+                    try:
+                        errors = apply(pending)
+                    except Exception as e:
+                        LOG.error('Failed to apply batch:', exc_info=True)
+                        errors = {c['id']: str(e) for c in pending}
+                    now = time.time()
+                    results = {c['id']: {'error': errors.get(c['id']), 'time': now}
+                               for c in pending}
+                    result = results.pop(change['id'])
+                    if results:
+                        self._store_results(results)
+                else:
+                    METRICS.increment('changes_coalesced')
+        if result['error']:
+            raise RuntimeError(result['error'])
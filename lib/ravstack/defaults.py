@@ -28,6 +28,7 @@ def redirect(dirname, template=None):
 config_file = redirect('/etc/{prog_name}', '{prog_name}.conf')
 log_file = redirect('/var/log/{prog_name}', '{prog_name}.log')
 password_file = redirect('/var/run/{prog_name}', 'passwords.json')
+runtime_dir = redirect('/var/run/{prog_name}')
 
 
 config_schema = [
@@ -35,6 +36,14 @@ config_schema = [
     CI(prog_name, 'debug', 'False', False, 'Enable debugging.', 'DEBUG', '--debug'),
     CI(prog_name, 'verbose', 'False', False, 'Be verbose.', 'VERBOSE', '--verbose'),
     CI(prog_name, 'log_stderr', 'False', False, 'Log to stderr.', 'LOG_STDERR', '--log-stderr'),
+    CI(prog_name, 'prometheus_file', '<None>', False,
+            'Export API metrics to this Prometheus textfile.', None, None),
+    CI(prog_name, 'trace_file', '<None>', False,
+            'Append command traces to this file as JSON lines.', None, None),
+    CI(prog_name, 'runtime_users', 'stack', False,
+            'Users that get a private runtime directory (comma separated).', None, None),
+    CI('ravello', 'api_url', 'https://cloud.ravellosystems.com/api/v1', False,
+            'Ravello API URL.', 'RAVELLO_API_URL', None),
     CI('ravello', 'username', '<None>', True,
             'Ravello API username.', 'RAVELLO_USERNAME', '--username'),
     CI('ravello', 'password', '<None>', True,
@@ -45,8 +54,49 @@ config_schema = [
             'Name of PXE boot ISO image.', None, '--pxe-iso'),
     CI('ravello', 'min_runtime', '120', False,
             'Minimum application runtime (in minutes).', None, None),
+    CI('ravello', 'cache_max_age', '10', False,
+            'Maximum age of a cached application snapshot (in seconds).', None, None),
+    CI('ravello', 'max_parallel', '8', False,
+            'Maximum number of nodes that are started or stopped in parallel.', None, None),
+    CI('ravello', 'dedup_window', '1', False,
+            'Window for sharing the results of identical GET requests between '
+            'processes (in seconds, 0 to disable).', None, None),
+    CI('ravello', 'rate_limit', '0', False,
+            'Maximum sustained rate of API requests for all processes of a user (in '
+            'requests per second, 0 to disable).', None, None),
+    CI('ravello', 'rate_burst', '10', False,
+            'Maximum burst of API requests when rate limiting.', None, None),
+    CI('ravello', 'rate_reserve', '4', False,
+            'Tokens reserved for power actions when rate limiting.', None, None),
+    CI('ravello', 'breaker_threshold', '3', False,
+            'Number of connection failures or timeouts after which API requests fail '
+            'fast (0 to disable).', None, None),
+    CI('ravello', 'breaker_window', '120', False,
+            'Window for counting connection failures (in seconds).', None, None),
+    CI('ravello', 'breaker_cooldown', '60', False,
+            'Time that API requests fail fast before a probe is made (in seconds).',
+            None, None),
     CI('proxy', 'key_name', 'id_ravstack', False, 'API proxy keypair name.', None, None),
     CI('proxy', 'proxy_name', 'ravstack-proxy', False, 'API proxy script.', None, None),
+    CI('proxy', 'snapshot_max_age', '5', False,
+            'Maximum age of the application snapshot in the proxy daemon (in seconds).',
+            None, None),
+    CI('proxy', 'poll_interval', '30', False,
+            'Interval for refreshing the application in the proxy daemon (in seconds, '
+            '0 to disable).', None, None),
+    CI('proxy', 'write_behind', 'false', False,
+            'Queue power actions in the proxy daemon and return right away.',
+            None, None),
+    CI('proxy', 'coalesce_window', '0', False,
+            'Extra time to wait for more boot device changes before applying them '
+            '(in seconds).', None, None),
+    CI('gateway', 'address', '127.0.0.1', False,
+            'Address for the API gateway to listen on.', None, None),
+    CI('gateway', 'port', '8484', False, 'Port for the API gateway to listen on.', None, None),
+    CI('gateway', 'upstream_url', 'https://cloud.ravellosystems.com/api/v1', False,
+            'Ravello API URL used by the API gateway.', None, None),
+    CI('gateway', 'cache_max_age', '2', False,
+            'Maximum age of a cached response in the API gateway (in seconds).', None, None),
     CI('tripleo', 'nodes_file', '~/instackenv.json', False,
             'File name containing node definitions.', None, None),
     CI('tripleo', 'undercloud_env', '~/stackrc', False, 'Undercloud rc file.', None, None),
@@ -8,10 +8,12 @@
 
 from __future__ import absolute_import, print_function
 
+import os
 import json
 import copy
+import time
 
-from . import ravello, util
+from . import ravello, util, cache, runtime, trace, ratelimit, breaker, parallel
 from .runtime import LOG, CONF
 
 
@@ -46,7 +48,22 @@ def get_ravello_client(env):
     """Return a API client connection."""
     username = env.config.require('ravello', 'username')
     password = env.config.require('ravello', 'password')
-    client = ravello.RavelloClient()
+    client = ravello.RavelloClient(env.config['ravello']['api_url'])
+    rtdir = runtime.get_runtime_dir()
+    if rtdir:
+        client.session_cache = cache.SessionCache(os.path.join(rtdir, 'sessions.json'))
+        client.snapshot_cache = cache.SnapshotCache(rtdir, client.default_url)
+        cfg = env.config['ravello']
+        if cfg.getfloat('dedup_window') > 0:
+            client.request_cache = cache.RequestCache(rtdir, client.default_url,
+                                                      cfg.getfloat('dedup_window'))
+        if cfg.getfloat('rate_limit') > 0:
+            client.rate_limiter = ratelimit.RateLimiter(os.path.join(rtdir, 'ratelimit.json'),
+                                                        cfg.getfloat('rate_limit'),
+                                                        cfg.getint('rate_burst'),
+                                                        cfg.getint('rate_reserve'))
+        if cfg.getint('breaker_threshold') > 0:
+            client.breaker = get_breaker(env)
     try:
         client.login(username, password)
     except ravello.HTTPError:
@@ -58,23 +75,143 @@ def get_ravello_client(env):
     return client
 
 
-def get_ravello_application(env):
-    """Return the Ravello application we're working in."""
+def get_breaker(env):
+    """Return the API circuit breaker, or ``None`` if there is no runtime
+    directory."""
+    fname = breaker.get_breaker_name()
+    if fname is None:
+        return
+    cfg = env.config['ravello']
+    return breaker.CircuitBreaker(fname, cfg.getint('breaker_threshold'),
+                                  cfg.getfloat('breaker_window'),
+                                  cfg.getfloat('breaker_cooldown'))
+
+
+def get_ravello_application(env, max_age=None):
+    """Return the Ravello application we're working in.
+
+    A cached snapshot of the application is returned if it is not older than
+    *max_age* seconds. The default is the `cache_max_age` config setting, or
+    zero if `--refresh` was specified.
+    """
+    with trace.span('get-application') as sp:
+        return _get_ravello_application(env, max_age, sp)
+
+
+def _get_ravello_application(env, max_age, sp):
     name = env.config.require('ravello', 'application')
-    apps = env.client.call('POST', '/applications/filter', ravello.simple_filter(name=name))
-    if len(apps) == 0:
-        raise RuntimeError('Application `{}` not found'.format(name))
-    app = env.client.call('GET', '/applications/{id}'.format(**apps[0]))
+    if max_age is None:
+        max_age = 0 if env.args.get('--refresh') \
+                        else env.config['ravello'].getfloat('cache_max_age')
+    snapshots = env.client.snapshot_cache
+    appid = snapshots.get_id(name) if snapshots else None
+    if appid is None:
+        apps = env.client.call('POST', '/applications/filter', ravello.simple_filter(name=name))
+        if len(apps) == 0:
+            raise RuntimeError('Application `{}` not found'.format(name))
+        appid = apps[0]['id']
+        if snapshots:
+            snapshots.set_id(name, appid)
+    app = snapshots.load(appid, max_age) if snapshots and max_age > 0 else None
+    sp.set(cached=app is not None)
+    if app is not None:
+        return app
+    fetched = time.time()
+    try:
+        app = env.client.call('GET', '/applications/{}'.format(appid))
+    except ravello.HTTPError as e:
+        if not snapshots or e.response.status_code != 404:
+            raise
+        # The application was deleted and possibly re-created under a new ID.
+        snapshots.set_id(name, None)
+        return get_ravello_application(env, max_age)
     for vm in ravello.get_vms(app):
-        if not vm.get('networkConnections'):
-            continue
-        # Sort network connections on index in case they stop coming back
-        # sorted at some point. We assume the first connection is the access
-        # network, and the second is the management network.
-        vm['networkConnections'].sort(key=lambda c: c['device']['index'])
+        sort_connections(vm)
+    if snapshots:
+        snapshots.save(appid, app, fetched)
+        save_index(snapshots, app)
     return app
 
 
+def sort_connections(vm):
+    """Sort the network connections of *vm*."""
+    if not vm.get('networkConnections'):
+        return
+    # Sort network connections on index in case they stop coming back
+    # sorted at some point. We assume the first connection is the access
+    # network, and the second is the management network.
+    vm['networkConnections'].sort(key=lambda c: c['device']['index'])
+
+
+def save_index(snapshots, app):
+    """Store the VM IDs and expiration time of *app* in the cache."""
+    vms = {}
+    for scope in ('design', 'deployment'):
+        for vm in ravello.get_vms(app, scope):
+            if 'id' in vm:
+                vms[vm['name']] = vm['id']
+    snapshots.save_index(app['id'], vms, app.get('nextStopTime'))
+
+
+# Beyond this number of VM fetches, loading the entire application is cheaper.
+max_vm_fetches = 2
+
+def get_node_application(env, nodenames, scopes=('deployment',)):
+    """Return the application with just the VMs *nodenames* in *scopes*.
+
+    The VMs are loaded with the VM level API call, using cached application
+    and VM IDs. This transfers and parses much less data than loading the
+    entire application, which is done instead if the IDs are not cached, or
+    if too many VMs are needed. The application is always loaded fresh.
+
+    The returned application has a "partial" flag if not all VMs are present.
+    It must never be used for a full update of the application.
+    """
+    snapshots = env.client.snapshot_cache
+    name = env.config.require('ravello', 'application')
+    appid = snapshots.get_id(name) if snapshots else None
+    index = snapshots.load_index(appid) if appid else None
+    if index is None or len(nodenames) * len(scopes) > max_vm_fetches \
+                or any(nodename not in index['vms'] for nodename in nodenames):
+        return get_ravello_application(env, max_age=0)
+    app = {'id': appid, 'name': name, 'nextStopTime': index['nextStopTime'],
+           'partial': True}
+    calls = [('GET', '/applications/{}/vms/{};{}'.format(appid, index['vms'][nodename], scope))
+             for scope in scopes for nodename in nodenames]
+    with trace.span('get-vms', count=len(calls)):
+        try:
+            vms = parallel.call_many(env.client, calls)
+        except ravello.HTTPError as e:
+            if e.response.status_code != 404:
+                raise
+            # A VM was deleted or re-created under a new ID.
+            return get_ravello_application(env, max_age=0)
+    for ix, scope in enumerate(scopes):
+        app[scope] = {'vms': vms[ix*len(nodenames):(ix+1)*len(nodenames)]}
+        for vm in app[scope]['vms']:
+            sort_connections(vm)
+    return app
+
+
+def update_next_stop(env, app, next_stop):
+    """Record that the runtime of *app* was extended to *next_stop*."""
+    app['nextStopTime'] = next_stop
+    snapshots = env.client.snapshot_cache
+    index = snapshots.load_index(app['id']) if snapshots else None
+    if index is not None:
+        snapshots.save_index(app['id'], index['vms'], next_stop)
+
+
+def refresh_application(env):
+    """Reload `env.application`, bypassing the cache.
+
+    This is used by commands that change the application, as they need to
+    start from its current state.
+    """
+    env.application = get_ravello_application(env, max_age=0)
+    return env.application
+
+
 def get_nodes(app):
     """Return a list of "nodes" in the application.
 
@@ -142,6 +279,9 @@ def get_environ(args):
     env.logger = LOG
     env.config = CONF
     env.args = args
+    env.shared_snapshot = False
+    env.node_table = None
+    env.power_queue = None
     env.lazy_attr('client', lambda: get_ravello_client(env))
     env.lazy_attr('application', lambda: get_ravello_application(env))
     env.lazy_attr('nodes', lambda: get_nodes(env.application))
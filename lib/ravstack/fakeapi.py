@@ -0,0 +1,479 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+"""Local stand-in for the Ravello API.
+
+Usage:
+  ravstack.fakeapi [options]
+
+This is a module that is run as `python -mravstack.fakeapi`.
+
+Options:
+  -p <port>, --port <port>
+                        Port to listen on. [default: 0]
+  -a <name>, --application <name>
+                        Name of the application to create. [default: bench]
+  -n <count>, --nodes <count>
+                        Number of nodes to create. [default: 10]
+  --latency <spec>      Per-endpoint latency in seconds, for example:
+                        "GET /applications/{id}=0.2,*=0.05".
+  --errors <spec>       Per-endpoint error injection with a status and a
+                        probability, for example:
+                        "PUT /applications/{id}=409:0.1".
+  --delays <spec>       Time spent in transient VM states, for example:
+                        "STARTING=30,STOPPING=10". [default: ]
+  --log <file>          Log requests to <file> as JSON lines.
+"""
+
+from __future__ import absolute_import, print_function
+
+import os
+import re
+import sys
+import json
+import time
+import base64
+import random
+import threading
+import collections
+
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlsplit, parse_qs
+
+# This implements the subset of the Ravello API that is used by ravstack. The
+# API is served under /api/v1 so that `RavelloClient.default_url` can point to
+# `http://localhost:<port>/api/v1`. Some extra endpoints under /_fake are
+# available to inspect and reset the call statistics, and to change the
+# configuration (latency, error injection, VM state transition delays).
+#
+# VM state transitions are modeled after Ravello: an action puts a VM in a
+# transient state (e.g. STARTING) for a configurable time, after which it
+# moves to the final state (e.g. STARTED). Actions are refused with a 409 if
+# the VM is not in the right state.
+
+_re_id = re.compile('/[0-9]+')
+
+
+def url_template(path):
+    """Return the URL template for *path* (e.g. /applications/{id})."""
+    return _re_id.sub('/{id}', path)
+
+
+def create_vm(vmid, name, ips, macs, cpus=2, memory=8192, disk=60):
+    """Create a VM definition."""
+    vm = {'id': vmid,
+          'name': name,
+          'description': '',
+          'numCpus': cpus,
+          'memorySize': {'value': memory, 'unit': 'MB'},
+          'stopTimeOut': 180,
+          'hardDrives': [{'id': vmid*10+1, 'index': 1, 'type': 'DISK', 'name': 'sda',
+                          'boot': True, 'controller': 'virtio',
+                          'size': {'value': disk, 'unit': 'GB'}},
+                         {'id': vmid*10+2, 'index': 2, 'type': 'CDROM', 'name': 'cdrom',
+                          'controller': 'IDE', 'baseDiskImageId': 1}]}
+    conns = vm['networkConnections'] = []
+    for ix, (ip, mac) in enumerate(zip(ips, macs)):
+        conns.append({'name': 'eth{}'.format(ix),
+                      'device': {'index': ix, 'deviceType': 'virtio',
+                                 'useAutomaticMac': False, 'mac': mac},
+                      'ipConfig': {'hasPublicIp': False,
+                                   'externalAccessState': 'ALWAYS_PUBLIC_IP',
+                                   'staticIpConfig': {'ip': ip, 'mask': '255.255.0.0'}}})
+    vm['suppliedServices'] = [{'name': 'ssh', 'portRange': '22', 'protocol': 'TCP',
+                               'external': True, 'ip': ips[-1]}]
+    return vm
+
+
+def create_application(appid, name, nnodes):
+    """Create an application with an undercloud and *nnodes* nodes."""
+    vms = []
+    for i in range(nnodes + 1):
+        vmid = appid * 10000 + i + 1
+        vmname = 'undercloud' if i == 0 else 'node{}'.format(i)
+        ips = ['10.{}.{}.{}'.format(net, (10+i) >> 8, (10+i) & 0xff) for net in (2, 4)]
+        macs = ['2c:c2:60:{:02x}:{:02x}:{:02x}'.format(net, i >> 8, i & 0xff)
+                for net in (2, 4)]
+        vm = create_vm(vmid, vmname, ips, macs)
+        vm['state'] = 'STARTED' if i == 0 else 'STOPPED'
+        vms.append(vm)
+    design = json.loads(json.dumps(vms))
+    for vm in design:
+        del vm['state']
+    return {'id': appid,
+            'name': name,
+            'published': True,
+            'nextStopTime': int((time.time() + 4*3600) * 1000),
+            'design': {'vms': design},
+            'deployment': {'vms': vms, 'totalActiveVms': 1}}
+
+
+class FakeRavello(object):
+    """The state of the fake API."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.applications = {}
+        self.disk_images = [{'id': 1, 'name': 'ipxe.iso'}]
+        self.sessions = set()
+        self.stats = collections.Counter()
+        self.latency = {}
+        self.errors = {}
+        self.delays = {}
+        self.log_file = None
+        self.transitions = {}
+        self.random = random.Random()
+        self._next_id = 1
+        self._next_vmid = 1000000
+
+    def configure(self, settings):
+        """Update the configuration from a dictionary with the keys "latency",
+        "errors", "delays" and "log"."""
+        with self.lock:
+            self.latency.update(settings.get('latency', {}))
+            for key, value in settings.get('errors', {}).items():
+                self.errors[key] = tuple(value)
+            self.delays.update(settings.get('delays', {}))
+            if settings.get('log'):
+                self.log_file = open(settings['log'], 'a')
+
+    def get_latency(self, endpoint):
+        """Return the latency for *endpoint*."""
+        return self.latency.get(endpoint, self.latency.get('*', 0))
+
+    def inject_error(self, endpoint):
+        """Return a status code to inject for *endpoint*, or ``None``."""
+        status, probability = self.errors.get(endpoint, self.errors.get('*', (None, 0)))
+        if self.random.random() < probability:
+            return status
+
+    def log_request(self, entry):
+        """Log a request."""
+        if self.log_file is None:
+            return
+        with self.lock:
+            self.log_file.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.log_file.flush()
+
+    def set_state(self, app, vm, transient, final):
+        """Put *vm* into state *transient*, and into *final* after a delay."""
+        delay = self.delays.get(transient, 0)
+        if delay <= 0:
+            vm['state'] = final
+            return
+        vm['state'] = transient
+        self.transitions[(app['id'], vm['id'])] = (final, time.time() + delay)
+
+    def advance(self):
+        """Complete the state transitions that are due."""
+        now = time.time()
+        for key, (final, deadline) in list(self.transitions.items()):
+            if deadline > now:
+                continue
+            del self.transitions[key]
+            app = self.applications.get(key[0])
+            for vm in app['deployment']['vms'] if app else []:
+                if vm['id'] == key[1]:
+                    vm['state'] = final
+
+    def add_application(self, name, nnodes):
+        """Add a new application with *nnodes* nodes."""
+        with self.lock:
+            app = create_application(self._next_id, name, nnodes)
+            self.applications[app['id']] = app
+            self._next_id += 1
+            return app
+
+    def get_application(self, appid):
+        app = self.applications.get(int(appid))
+        if app is None:
+            raise ApiError(404, 'Not Found')
+        return app
+
+    def get_vm(self, app, vmid, scope='deployment'):
+        for vm in app[scope]['vms']:
+            if vm['id'] == int(vmid):
+                return vm
+        raise ApiError(404, 'Not Found')
+
+    def login(self, handler, body):
+        auth = handler.headers.get('Authorization', '')
+        if not auth.startswith('Basic '):
+            raise ApiError(401, 'Unauthorized')
+        username = base64.b64decode(auth[6:].encode('ascii')).decode('utf-8').split(':')[0]
+        token = base64.b16encode(os.urandom(8)).decode('ascii')
+        self.sessions.add(token)
+        handler.cookies['JSESSIONID'] = token
+        return {'name': username, 'organizationProfile': {'organizationName': 'fake'}}
+
+    def logout(self, handler, body):
+        self.sessions.discard(handler.session)
+
+    def filter_applications(self, handler, body):
+        result = []
+        for app in self.applications.values():
+            for crit in body['criteria']:
+                if app.get(crit['propertyName']) != crit['operand']:
+                    break
+            else:
+                result.append({'id': app['id'], 'name': app['name']})
+        return result
+
+    def get_app(self, handler, body, appid):
+        return self.get_application(appid)
+
+    def put_app(self, handler, body, appid):
+        app = self.get_application(appid)
+        vms = body.get('design', {}).get('vms', [])
+        for vm in vms:
+            if 'id' not in vm:
+                vm['id'] = self._next_vmid
+                self._next_vmid += 1
+            for conn in vm.get('networkConnections', []):
+                dev = conn.get('device', {})
+                if dev.get('useAutomaticMac') and 'generatedMac' not in dev:
+                    dev['generatedMac'] = '2c:c2:60:ff:{:02x}:{:02x}'.format(
+                                vm['id'] >> 8 & 0xff, vm['id'] & 0xff)
+        app['design'] = {'vms': vms}
+        return app
+
+    def get_vm_scope(self, handler, body, appid, vmid, scope):
+        return self.get_vm(self.get_application(appid), vmid, scope)
+
+    def put_vm(self, handler, body, appid, vmid):
+        app = self.get_application(appid)
+        vms = app['design']['vms']
+        vm = self.get_vm(app, vmid, 'design')
+        body['id'] = vm['id']
+        vms[vms.index(vm)] = body
+        return body
+
+    def publish_updates(self, handler, body, appid):
+        app = self.get_application(appid)
+        start = handler.query.get('startAllDraftVms', ['true'])[0] == 'true'
+        current = dict((vm['id'], vm) for vm in app['deployment']['vms'])
+        vms = json.loads(json.dumps(app['design']['vms']))
+        app['deployment']['vms'] = vms
+        for vm in vms:
+            old = current.get(vm['id'])
+            if old is None:
+                if start:
+                    self.set_state(app, vm, 'STARTING', 'STARTED')
+                else:
+                    vm['state'] = 'STOPPED'
+                continue
+            state = old.pop('state')
+            changed = vm != old
+            old['state'] = vm['state'] = state
+            # A running VM that is changed is updated (restarted) by Ravello.
+            if state == 'STARTED' and changed:
+                self.set_state(app, vm, 'UPDATING', 'STARTED')
+
+    def set_expiration(self, handler, body, appid):
+        app = self.get_application(appid)
+        app['nextStopTime'] = int((time.time() + body['expirationFromNowSeconds']) * 1000)
+
+    _vm_actions = {'start': ('STOPPED', 'STARTING', 'STARTED'),
+                   'stop': ('STARTED', 'STOPPING', 'STOPPED'),
+                   'poweroff': ('STARTED', 'STOPPING', 'STOPPED'),
+                   'restart': ('STARTED', 'RESTARTING', 'STARTED')}
+
+    def vm_action(self, handler, body, appid, vmid, action):
+        app = self.get_application(appid)
+        vm = self.get_vm(app, vmid)
+        required, transient, final = self._vm_actions[action]
+        if vm['state'] != required:
+            raise ApiError(409, 'Conflict')
+        self.set_state(app, vm, transient, final)
+
+    def get_disk_images(self, handler, body):
+        return self.disk_images
+
+    routes = [
+        ('POST', '/login', 'login'),
+        ('POST', '/logout', 'logout'),
+        ('POST', '/applications/filter', 'filter_applications'),
+        ('GET', '/applications/([0-9]+)', 'get_app'),
+        ('PUT', '/applications/([0-9]+)', 'put_app'),
+        ('GET', '/applications/([0-9]+)/vms/([0-9]+);(deployment|design)', 'get_vm_scope'),
+        ('PUT', '/applications/([0-9]+)/vms/([0-9]+)', 'put_vm'),
+        ('POST', '/applications/([0-9]+)/publishUpdates', 'publish_updates'),
+        ('POST', '/applications/([0-9]+)/setExpiration', 'set_expiration'),
+        ('POST', '/applications/([0-9]+)/vms/([0-9]+)/(start|stop|poweroff|restart)',
+                'vm_action'),
+        ('GET', '/diskImages', 'get_disk_images'),
+    ]
+
+    def dispatch(self, handler, method, path, body):
+        """Dispatch a request. Return the response body. Must be called with
+        the lock held."""
+        for route_method, route, name in self.routes:
+            match = re.match(route + '$', path)
+            if route_method == method and match:
+                break
+        else:
+            raise ApiError(404, 'Not Found')
+        if name != 'login' and handler.session not in self.sessions:
+            raise ApiError(401, 'Unauthorized')
+        self.advance()
+        return getattr(self, name)(handler, body, *match.groups())
+
+
+class ApiError(Exception):
+    """An error response."""
+
+    def __init__(self, status, reason):
+        super(ApiError, self).__init__(status, reason)
+        self.status = status
+        self.reason = reason
+
+
+class FakeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler for the fake API."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    prefix = '/api/v1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_response_body(self, status, reason, content='', headers=None):
+        content = content.encode('utf-8')
+        self.send_response(status, reason)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in self.cookies.items():
+            self.send_header('Set-Cookie', '{}={}; Path=/'.format(name, value))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def handle_request(self, method):
+        api = self.server.api
+        parsed = urlsplit(self.path)
+        self.query = parse_qs(parsed.query)
+        self.cookies = {}
+        cookie = self.headers.get('Cookie', '')
+        match = re.search('JSESSIONID=([0-9A-F]+)', cookie)
+        self.session = match.group(1) if match else None
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length).decode('utf-8')) if length else None
+        path = parsed.path
+        if path.startswith('/_fake/'):
+            self.handle_fake(method, path, body)
+            return
+        if path.startswith(self.prefix):
+            path = path[len(self.prefix):]
+        endpoint = '{} {}'.format(method, url_template(path))
+        start_time = time.time()
+        with api.lock:
+            api.stats[endpoint] += 1
+            latency = api.get_latency(endpoint)
+            status = api.inject_error(endpoint)
+        if latency:
+            time.sleep(latency)
+        content, headers = '', {}
+        try:
+            if status is not None:
+                raise ApiError(status, 'Injected Error')
+            with api.lock:
+                response = api.dispatch(self, method, path, body)
+                if response is not None:
+                    content = json.dumps(response)
+        except ApiError as e:
+            status, reason = e.status, e.reason
+            headers = {'Error-Code': str(e.status), 'Error-Message': e.reason}
+            if status in (429, 503):
+                headers['Retry-After'] = '1'
+        else:
+            status, reason = 200, 'OK'
+        self.send_response_body(status, reason, content, headers)
+        api.log_request({'time': start_time, 'method': method, 'path': path,
+                         'endpoint': endpoint, 'status': status, 'bytes': len(content),
+                         'duration': time.time() - start_time})
+
+    def handle_fake(self, method, path, body):
+        api = self.server.api
+        if path == '/_fake/stats' and method == 'GET':
+            with api.lock:
+                content = json.dumps(dict(api.stats))
+            self.send_response_body(200, 'OK', content)
+        elif path == '/_fake/reset' and method == 'POST':
+            with api.lock:
+                api.stats.clear()
+            self.send_response_body(200, 'OK')
+        elif path == '/_fake/config' and method == 'POST':
+            api.configure(body)
+            self.send_response_body(200, 'OK')
+        else:
+            self.send_response_body(404, 'Not Found')
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+
+class FakeServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """HTTP server for the fake API."""
+
+    daemon_threads = True
+
+    def __init__(self, address, api=None):
+        BaseHTTPServer.HTTPServer.__init__(self, address, FakeHandler)
+        self.api = api or FakeRavello()
+
+    @property
+    def url(self):
+        return 'http://{}:{}{}'.format(self.server_address[0], self.server_address[1],
+                                       FakeHandler.prefix)
+
+
+def parse_spec(spec, convert=float):
+    """Parse a "key=value,..." specification into a dictionary."""
+    result = {}
+    for item in (spec or '').split(','):
+        if not item:
+            continue
+        key, value = item.rsplit('=', 1)
+        result[key.strip()] = convert(value)
+    return result
+
+
+def parse_error(value):
+    """Parse a "status:probability" error specification."""
+    status, probability = value.split(':')
+    return (int(status), float(probability))
+
+
+def main():
+    """Run the fake API from the command line."""
+    import docopt
+    args = docopt.docopt(__doc__)
+    server = FakeServer(('127.0.0.1', int(args['--port'])))
+    server.api.configure({'latency': parse_spec(args['--latency']),
+                          'errors': parse_spec(args['--errors'], parse_error),
+                          'delays': parse_spec(args['--delays']),
+                          'log': args['--log']})
+    server.api.add_application(args['--application'], int(args['--nodes']))
+    print(server.url)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,7 @@
 from __future__ import absolute_import, print_function
 
 import textwrap
-from . import ravello, util, compat
+from . import ravello, util, compat, factory, watch
 
 
 def build_mac_map(nova):
@@ -91,19 +91,22 @@ def fixup_ravello(env):
     # the host name, add some aliases. Then for controller nodes only, enable
     # some external services.
     updated = set()
+    update = ravello.ApplicationUpdate(env.client, app)
     # Fixup IPs / name / aliases
     for vm in ravello.get_vms(app, 'design'):
         if update_addresses(vm, env.mac_map):
             updated.add(vm['name'])
+            update.touch(vm)
     # Add supplied services on the controller.
     for vm in ravello.get_vms(app, 'design'):
         if ctrlname not in vm['name']:
             continue
         if update_services(vm, env.mac_map):
             updated.add(vm['name'])
-    if not updated:
+            update.touch(vm)
+    if not update.has_changes():
         return
-    env.client.call('PUT', '/applications/{id}'.format(**app), app)
+    app = update.push()
     env.client.call('POST', '/applications/{id}/publishUpdates'.format(**app))
     print('Fixed Ravello config for {} nodes.'.format(len(updated)))
 
@@ -212,21 +215,16 @@ def fixup_os_config(env):
     print('Fixed OS config {} nodes.'.format(len(updated)))
 
 
-def wait_and_reload(client, app):
-    """Wait until all VMs are in the STARTED state."""
-    app = [app]  # nonlocal
-    def wait_for_vms_ready():
-        app[0] = client.call('GET', '/applications/{id}'.format(**app))
-        for vm in ravello.get_vms(app):
-            if vm['state'] != 'STARTED':
-                raise ravello.Retry('Node `{name}` in state `{state}`.'.format(**vm))
-    ravello.retry_operation(wait_for_vms_ready)
-    return app[0]
+def wait_and_reload(env):
+    """Wait until all VMs are in the STARTED state. Return the application."""
+    watcher = watch.VmWatcher(env)
+    return watcher.wait(lambda vm: vm['state'] == 'STARTED')
 
 
 def do_fixup(env):
     """The `ravstack fixup` command."""
     env.mac_map = build_mac_map(env.nova_under)
+    factory.refresh_application(env)
     fixup_ravello(env)
-    env.application = wait_and_reload(env.client, env.application)
+    env.application = wait_and_reload(env)
     fixup_os_config(env)
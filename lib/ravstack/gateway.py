@@ -0,0 +1,256 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import re
+import time
+import hashlib
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.http_cookiejar import DefaultCookiePolicy
+
+from . import runtime
+from .runtime import LOG, CONF
+from .metrics import METRICS
+
+# The gateway is an optional local HTTP server that sits in front of the
+# Ravello API. Ravstack processes use it by setting `[ravello]api_url` to its
+# URL. Compared to each process talking to the API directly, it provides:
+#
+#  - Persistent, pooled TLS connections to the API.
+#  - A logged-in session per user. A login with the same credentials as a
+#    previous login returns the existing session.
+#  - A short lived cache of GET responses, per session. Any other call to an
+#    application invalidates the cached responses for that application.
+#  - Collapsing of identical concurrent GET requests.
+#
+# Only the status, body and a few headers of a response are passed on to the
+# client. Cookies are passed on without their domain, so that the client sends
+# them back to the gateway.
+#
+# The upstream session is shared by all users, so it must not keep any
+# cookies: each request is sent upstream with the cookies of its own client
+# only. Requests without a session cookie, other than a login, are rejected.
+
+_re_app_url = re.compile('/applications/([0-9]+)')
+
+_passed_headers = ('Content-Type', 'Error-Code', 'Error-Message', 'Retry-After')
+
+
+class Response(object):
+    """A response from the API, as passed on to the client."""
+
+    def __init__(self, status, reason, content, headers, cookies=None):
+        self.status = status
+        self.reason = reason
+        self.content = content
+        self.headers = headers
+        self.cookies = cookies or {}
+        self.time = time.time()
+
+
+class Gateway(object):
+    """A caching gateway to the API at *url*."""
+
+    timeout = (10, 60)
+
+    def __init__(self, url, max_age, pool_size=10):
+        self.url = url
+        self.max_age = max_age
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        adapter = HTTPAdapter(max_retries=3, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._logins = {}
+        self._cache = {}
+        self._inflight = {}
+        # Incremented on every invalidation. A response that was requested
+        # before an invalidation is not cached.
+        self._generation = 0
+
+    def forward(self, method, path, headers, body):
+        """Forward a request to the API and return a :class:`Response`."""
+        headers = dict((name, value) for name, value in headers.items()
+                       if name.lower() in ('accept', 'authorization', 'content-type', 'cookie'))
+        try:
+            r = self.session.request(method, self.url + path, headers=headers, data=body,
+                                     timeout=self.timeout, allow_redirects=False)
+        except requests.RequestException as e:
+            LOG.error('Request `{} {}` failed: {!s}'.format(method, path, e))
+            return Response(502, 'Bad Gateway', b'', {'Error-Message': str(e)})
+        headers = dict((name, r.headers[name]) for name in _passed_headers
+                       if name in r.headers)
+        cookies = dict((cookie.name, cookie.value) for cookie in r.cookies)
+        return Response(r.status_code, r.reason, r.content, headers, cookies)
+
+    def _login(self, headers, body):
+        headers = CaseInsensitiveDict((name, value) for name, value in headers.items()
+                                      if name.lower() != 'cookie')
+        # Logins are keyed by a hash of the credentials.
+        key = hashlib.sha256(headers.get('Authorization', '').encode('utf-8')).hexdigest()
+        with self._lock:
+            response = self._logins.get(key)
+        if response is not None:
+            METRICS.increment('gateway_logins_reused')
+            return response
+        response = self.forward('POST', '/login', headers, body)
+        if response.status == 200:
+            with self._lock:
+                self._logins[key] = response
+        return response
+
+    def _forget_session(self, cookie):
+        """Forget the login and cached responses for session *cookie*."""
+        with self._lock:
+            for key, response in list(self._logins.items()):
+                if all(value in cookie for value in response.cookies.values()):
+                    del self._logins[key]
+            for key in list(self._cache):
+                if key[0] == cookie:
+                    del self._cache[key]
+            self._generation += 1
+
+    def _invalidate(self, path):
+        """Invalidate the cached responses affected by a change to *path*."""
+        match = _re_app_url.match(path)
+        with self._lock:
+            for key in list(self._cache):
+                cached = _re_app_url.match(key[1])
+                if match is None or cached and cached.group(1) == match.group(1):
+                    del self._cache[key]
+            self._generation += 1
+
+    def _get_cached(self, key):
+        with self._lock:
+            response = self._cache.get(key)
+        if response is not None and time.time() - response.time < self.max_age:
+            return response
+
+    def _get(self, path, headers):
+        key = (headers.get('Cookie', ''), path)
+        while True:
+            response = self._get_cached(key)
+            if response is not None:
+                METRICS.increment('gateway_cache_hits')
+                return response
+            with self._lock:
+                event = self._inflight.get(key)
+                if event is None:
+                    event = self._inflight[key] = threading.Event()
+                    generation = self._generation
+                    break
+            # Another thread is fetching the same resource. Wait for it, and
+            # use its response if it could be cached.
+            event.wait()
+            response = self._get_cached(key)
+            if response is not None:
+                METRICS.increment('gateway_requests_collapsed')
+                return response
+        try:
+            response = self.forward('GET', path, headers, None)
+            with self._lock:
+                if response.status == 200 and generation == self._generation:
+                    self._cache[key] = response
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            event.set()
+        return response
+
+    def handle(self, method, path, headers, body):
+        """Handle a request and return a :class:`Response`."""
+        if method == 'POST' and path == '/login':
+            return self._login(headers, body)
+        elif not headers.get('Cookie'):
+            return Response(401, 'Unauthorized', b'', {'Error-Message': 'Not logged in.'})
+        elif method == 'GET':
+            response = self._get(path, headers)
+        else:
+            # Also invalidate if the call failed, as it may have had an effect.
+            response = self.forward(method, path, headers, body)
+            self._invalidate(path)
+        if response.status == 401 or path == '/logout':
+            self._forget_session(headers.get('Cookie', ''))
+        return response
+
+
+class GatewayHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Request handler for the gateway."""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    prefix = '/api/v1'
+
+    def log_message(self, format, *args):
+        LOG.debug('{} - {}'.format(self.address_string(), format % args))
+
+    def handle_request(self, method):
+        if not self.path.startswith(self.prefix):
+            self.send_error(404)
+            return
+        path = self.path[len(self.prefix):]
+        length = int(self.headers.get('Content-Length', 0))
+        body = self.rfile.read(length) if length else None
+        response = self.server.gateway.handle(method, path, self.headers, body)
+        self.send_response(response.status, response.reason)
+        self.send_header('Content-Length', str(len(response.content)))
+        for name, value in response.headers.items():
+            self.send_header(name, value)
+        for name, value in response.cookies.items():
+            self.send_header('Set-Cookie', '{}={}; Path=/'.format(name, value))
+        self.end_headers()
+        self.wfile.write(response.content)
+        runtime.save_metrics()
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PUT(self):
+        self.handle_request('PUT')
+
+    def do_DELETE(self):
+        self.handle_request('DELETE')
+
+
+class GatewayServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """The gateway HTTP server."""
+
+    daemon_threads = True
+
+    def __init__(self, address, gateway):
+        BaseHTTPServer.HTTPServer.__init__(self, address, GatewayHandler)
+        self.gateway = gateway
+
+    @property
+    def url(self):
+        return 'http://{}:{}{}'.format(self.server_address[0], self.server_address[1],
+                                       GatewayHandler.prefix)
+
+
+def do_serve(env):
+    """The `ravstack gateway` command."""
+    cfg = CONF['gateway']
+    gateway = Gateway(cfg['upstream_url'], cfg.getfloat('cache_max_age'))
+    server = GatewayServer((cfg['address'], cfg.getint('port')), gateway)
+    LOG.info('Gateway for `{}` listening on `{}`.'.format(gateway.url, server.url))
+    print('Set `api_url = {}` in the [ravello] section to use the gateway.'
+                .format(server.url))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,54 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import json
+import time
+
+from . import util
+
+
+class BootDeviceJournal(object):
+    """A journal of pending boot device changes.
+
+    The journal is a JSON file in the runtime directory with an entry per
+    application ID and node name. Updates are done under a file lock and
+    atomically replace the file, so readers do not need to lock it.
+    """
+
+    def __init__(self, filename, appid):
+        self.filename = filename
+        self.appid = str(appid)
+
+    def _update(self, nodename, entry):
+        with util.lock_file(self.filename + '.lock'):
+            journal = util.read_json_file(self.filename, {})
+            nodes = journal.setdefault(self.appid, {})
+            if entry is None:
+                if nodes.pop(nodename, None) is None:
+                    return
+                if not nodes:
+                    del journal[self.appid]
+            else:
+                nodes[nodename] = entry
+            util.write_file_atomic(self.filename, json.dumps(journal, sort_keys=True))
+
+    def get(self, nodename):
+        """Return the pending boot device for *nodename*, or ``None``."""
+        journal = util.read_json_file(self.filename, {})
+        entry = journal.get(self.appid, {}).get(nodename)
+        return entry['bootdev'] if entry else None
+
+    def set(self, nodename, bootdev):
+        """Set the pending boot device for *nodename* to *bootdev*."""
+        self._update(nodename, {'bootdev': bootdev, 'time': time.time()})
+
+    def clear(self, nodename):
+        """Clear the pending boot device for *nodename*."""
+        self._update(nodename, None)
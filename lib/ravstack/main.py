@@ -11,30 +11,38 @@
 Usage:
   ravstack [options] setup
   ravstack [options] proxy-create
+  ravstack [options] proxyd
+  ravstack [options] gateway
   ravstack [options] node-create [-c <cpus>] [-m <memory>]
                                 [-D <disk>] [-n <count>]
   ravstack [options] node-dump
   ravstack [options] node-list [--all [--cached]]
-  ravstack [options] node-start <node>
-  ravstack [options] node-stop <node>
-  ravstack [options] node-reboot <node>
+  ravstack [options] node-inventory [--json]
+  ravstack [options] node-start (--all | <nodes>...)
+  ravstack [options] node-stop (--all | <nodes>...)
+  ravstack [options] node-reboot (--all | <nodes>...)
   ravstack [options] node-get-boot-device <node>
   ravstack [options] node-set-boot-device <node> <bootdev>
   ravstack [options] node-get-macs <node> [--cached]
   ravstack [options] fixup
   ravstack [options] endpoint-resolve <port> [-t <timeout>]
                      [--start-port <base>] [--num-ports <count>]
+  ravstack [options] stats [--prometheus | --reset]
   ravstack --help
 
 Command help:
   setup                 Create ravstack directories and config file.
   proxy-create          Create SSH -> Ravello API proxy.
+  proxyd                Run the proxy daemon that serves the SSH proxy.
+  gateway               Run a local caching gateway to the Ravello API.
   node-create           Create a new node.
   node-dump             Dump node definitions to specified file.
   node-list             List powered on nodes. (--all lists all nodes)
-  node-start            Start a node.
-  node-stop             Stop a node.
-  node-reboot           Reboot a node.
+  node-inventory        Show all nodes with their state, boot device,
+                        addresses and resources.
+  node-start            Start nodes.
+  node-stop             Stop nodes.
+  node-reboot           Reboot nodes.
   node-get-boot-device  Return boot device for <node>.
   node-set-boot-device  Set boot device for <node> to <bootdev>.
                         The boot device may be "hd" or "network".
@@ -43,6 +51,7 @@ Command help:
                         more nodes were deployed.
   endpoint-resolve      Resolve an endpoint for a local service using
                         a public IP address or under portmapping.
+  stats                 Show Ravello API call statistics.
 
 Options:
   -d, --debug           Enable debugging.
@@ -54,8 +63,10 @@ Options:
                         Ravello API password.
   -a <application>, --application=<application>
                         The Ravello application name.
-  --all                 List all nodes.
+  --all                 List or act on all nodes.
   --cached              Allow use of cached information.
+  --refresh             Do not use a cached copy of the application.
+  --json                Output in JSON format.
 
 Options for `node-create`:
   -c <cpus>, --cpus=<cpus>
@@ -74,13 +85,18 @@ Options for `endpoint-resolve`:
                         portmapping. [default: 10000]
   --num-ports <count>   Number of ports to scan for endpoint resulution
                         with portmapping. [default: 50]
+
+Options for `stats`:
+  --prometheus          Show statistics in Prometheus format.
+  --reset               Reset the statistics.
 """
 
 from __future__ import absolute_import, print_function
 
 import docopt
 
-from . import factory, setup, node, proxy, fixup, endpoint, runtime
+from . import factory, setup, node, proxy, proxyd, gateway, fixup, endpoint, metrics, runtime
+from . import trace
 from .runtime import CONF
 
 
@@ -91,6 +107,9 @@ def main():
     CONF.update_from_args(args)
     CONF.update_to_env()
     runtime.setup_logging()  # logging configuration might have changed
+    runtime.setup_tracing()
+    trace.annotate(command=' '.join(key for key, value in args.items()
+                                    if value is True and key[0] not in '-<'))
 
     env = factory.get_environ(args)
 
@@ -98,6 +117,10 @@ def main():
         setup.do_setup(env)
     elif args['proxy-create']:
         proxy.do_create(env)
+    elif args['proxyd']:
+        proxyd.do_serve(env)
+    elif args['gateway']:
+        gateway.do_serve(env)
     elif args['node-create']:
         node.do_create(env)
     elif args['node-dump']:
@@ -106,12 +129,14 @@ def main():
         node.do_list_running(env, False)
     elif args['node-list']:
         node.do_list_all(env)
+    elif args['node-inventory']:
+        node.do_inventory(env, args['--json'])
     elif args['node-start']:
-        node.do_start(env, args['<node>'])
+        node.do_group_action(env, 'start', args['<nodes>'], args['--all'])
     elif args['node-stop']:
-        node.do_stop(env, args['<node>'])
+        node.do_group_action(env, 'stop', args['<nodes>'], args['--all'])
     elif args['node-reboot']:
-        node.do_reboot(env, args['<node>'])
+        node.do_group_action(env, 'reboot', args['<nodes>'], args['--all'])
     elif args['node-get-boot-device']:
         node.do_get_boot_device(env, args['<node>'])
     elif args['node-set-boot-device']:
@@ -122,6 +147,8 @@ def main():
         fixup.do_fixup(env)
     elif args['endpoint-resolve']:
         endpoint.do_resolve(env, args['<port>'])
+    elif args['stats']:
+        metrics.do_stats(env)
 
 
 def run_main():
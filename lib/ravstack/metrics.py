@@ -0,0 +1,205 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import re
+import json
+import time
+import threading
+
+from . import util
+
+# Metrics are collected in memory by each process, and are merged into a
+# JSON stats file in the runtime directory when the process exits (or after
+# each command for the proxy daemon). The stats file is updated under a file
+# lock, so the totals are correct even with many concurrent proxy processes.
+# The totals can optionally be exported as a Prometheus textfile as well.
+
+# Upper bounds of the latency histogram buckets, in seconds.
+buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+_re_host = re.compile('^[a-z]+://[^/]*')
+_re_id = re.compile('/[0-9]+')
+
+
+def url_template(url):
+    """Return the URL template for a relative API URL, e.g.
+    `/applications/{id}`."""
+    url = _re_host.sub('', url.split('?')[0].split(';')[0])
+    return _re_id.sub('/{id}', url)
+
+
+def new_stats():
+    return {'since': time.time(), 'requests': {}, 'retries': {}, 'counters': {}}
+
+
+def merge_stats(total, delta):
+    """Merge the stats in *delta* into *total*."""
+    for endpoint, req in delta['requests'].items():
+        treq = total['requests'].setdefault(endpoint, new_request())
+        for key in ('count', 'seconds', 'bytes'):
+            treq[key] += req[key]
+        for status, count in req['status'].items():
+            treq['status'][status] = treq['status'].get(status, 0) + count
+        treq['buckets'] = [x+y for x, y in zip(treq['buckets'], req['buckets'])]
+    for name in ('retries', 'counters'):
+        for key, count in delta[name].items():
+            total[name][key] = total[name].get(key, 0) + count
+
+
+def new_request():
+    return {'count': 0, 'seconds': 0.0, 'bytes': 0, 'status': {},
+            'buckets': [0] * (len(buckets) + 1)}
+
+
+class Metrics(object):
+    """In-memory metrics for the current process."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stats = new_stats()
+        self.dirty = False
+
+    def record_request(self, method, url, status, elapsed, size):
+        """Record an API request. The *status* is the HTTP status code, or a
+        string describing the error if there was no response."""
+        endpoint = '{} {}'.format(method, url_template(url))
+        with self._lock:
+            req = self.stats['requests'].setdefault(endpoint, new_request())
+            req['count'] += 1
+            req['seconds'] += elapsed
+            req['bytes'] += size
+            status = str(status)
+            req['status'][status] = req['status'].get(status, 0) + 1
+            for ix, bound in enumerate(buckets):
+                if elapsed <= bound:
+                    break
+            else:
+                ix = len(buckets)
+            req['buckets'][ix] += 1
+            self.dirty = True
+
+    def record_retry(self, reason):
+        """Record a retry by `retry_operation()`. The *reason* is the HTTP
+        status code or "state" for an explicit retry."""
+        self.increment(str(reason), 'retries')
+
+    def increment(self, name, kind='counters'):
+        """Increment a generic counter."""
+        with self._lock:
+            counters = self.stats[kind]
+            counters[name] = counters.get(name, 0) + 1
+            self.dirty = True
+
+    def save(self, fname, prometheus_file=None):
+        """Merge the metrics collected since the last save into the stats file
+        *fname*, and export them to *prometheus_file* if provided."""
+        with self._lock:
+            if not self.dirty:
+                return
+            delta, self.stats, self.dirty = self.stats, new_stats(), False
+        with util.lock_file(fname + '.lock'):
+            total = util.read_json_file(fname) or new_stats()
+            merge_stats(total, delta)
+            util.write_file_atomic(fname, json.dumps(total, sort_keys=True))
+            if prometheus_file:
+                util.write_file_atomic(prometheus_file, render_prometheus(total), 0o644)
+
+
+METRICS = Metrics()
+
+
+def load_stats(fname):
+    """Load the stats file *fname*."""
+    return util.read_json_file(fname) or new_stats()
+
+
+def reset_stats(fname):
+    """Reset the stats file *fname*."""
+    with util.lock_file(fname + '.lock'):
+        util.write_file_atomic(fname, json.dumps(new_stats(), sort_keys=True))
+
+
+def _labels(**kwargs):
+    return ','.join('{}="{}"'.format(k, v.replace('"', '\\"'))
+                    for k, v in sorted(kwargs.items()))
+
+
+def render_prometheus(stats):
+    """Render *stats* in the Prometheus text exposition format."""
+    lines = []
+    def add(name, kind, help):
+        lines.append('# HELP ravstack_{} {}'.format(name, help))
+        lines.append('# TYPE ravstack_{} {}'.format(name, kind))
+    requests = sorted(stats['requests'].items())
+    add('api_requests_total', 'counter', 'Ravello API requests.')
+    for endpoint, req in requests:
+        method, path = endpoint.split(' ', 1)
+        for status, count in sorted(req['status'].items()):
+            lines.append('ravstack_api_requests_total{{{}}} {}'
+                            .format(_labels(method=method, path=path, status=status), count))
+    add('api_request_duration_seconds', 'histogram', 'Ravello API request latency.')
+    for endpoint, req in requests:
+        method, path = endpoint.split(' ', 1)
+        cumulative = 0
+        for bound, count in zip(buckets + ['+Inf'], req['buckets']):
+            cumulative += count
+            labels = _labels(method=method, path=path, le=str(bound))
+            lines.append('ravstack_api_request_duration_seconds_bucket{{{}}} {}'
+                            .format(labels, cumulative))
+        labels = _labels(method=method, path=path)
+        lines.append('ravstack_api_request_duration_seconds_sum{{{}}} {}'
+                            .format(labels, req['seconds']))
+        lines.append('ravstack_api_request_duration_seconds_count{{{}}} {}'
+                            .format(labels, req['count']))
+    add('api_response_bytes_total', 'counter', 'Ravello API response bytes.')
+    for endpoint, req in requests:
+        method, path = endpoint.split(' ', 1)
+        lines.append('ravstack_api_response_bytes_total{{{}}} {}'
+                            .format(_labels(method=method, path=path), req['bytes']))
+    add('api_retries_total', 'counter', 'Retries by retry_operation().')
+    for reason, count in sorted(stats['retries'].items()):
+        lines.append('ravstack_api_retries_total{{{}}} {}'
+                            .format(_labels(reason=reason), count))
+    add('events_total', 'counter', 'Other events.')
+    for name, count in sorted(stats['counters'].items()):
+        lines.append('ravstack_events_total{{{}}} {}'.format(_labels(event=name), count))
+    return '\n'.join(lines) + '\n'
+
+
+def do_stats(env):
+    """The `ravstack stats` command."""
+    from . import runtime, factory
+    fname = runtime.get_stats_file()
+    if fname is None:
+        raise RuntimeError('No runtime directory available.')
+    if env.args.get('--reset'):
+        reset_stats(fname)
+        print('Statistics reset.')
+        return
+    stats = load_stats(fname)
+    if env.args.get('--prometheus'):
+        print(render_prometheus(stats), end='')
+        return
+    since = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(stats['since']))
+    print('API calls since {}:'.format(since))
+    print('{:<48} {:>7} {:>8} {:>9}  {}'
+                .format('Endpoint', 'Calls', 'Avg ms', 'KB/call', 'Status'))
+    for endpoint, req in sorted(stats['requests'].items()):
+        status = ' '.join('{}:{}'.format(*item) for item in sorted(req['status'].items()))
+        print('{:<48} {:>7} {:>8.1f} {:>9.1f}  {}'
+                .format(endpoint, req['count'], 1000 * req['seconds'] / req['count'],
+                        req['bytes'] / 1024.0 / req['count'], status))
+    for name, title in (('retries', 'Retries'), ('counters', 'Events')):
+        if stats[name]:
+            print('{}: {}.'.format(title, ', '.join('{}: {}'.format(*item)
+                                    for item in sorted(stats[name].items()))))
+    breaker = factory.get_breaker(env)
+    if breaker is not None:
+        print('Circuit breaker: {}.'.format(breaker.get_status()))
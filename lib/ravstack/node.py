@@ -14,10 +14,12 @@ import json
 import time
 import tempfile
 import re
+import fnmatch
 
-from . import util, ravello
+from . import util, ravello, factory, nodedb, coalesce, journal, runtime, watch, parallel
 from .util import inet_aton, inet_ntoa
 from .ravello import retry_operation
+from .metrics import METRICS
 
 
 def get_vm(app, nodename, scope='deployment'):
@@ -129,7 +131,9 @@ def do_create(env):
     log = env.logger
     client = env.client
 
-    app = env.application
+    # The application and the PXE ISO are independent, so load them at once.
+    app, env.iso = parallel.retry_many(client, [lambda: factory.refresh_application(env),
+                                                lambda: factory.get_pxe_iso(env)])
     vms = ravello.get_vms(app)
     vm_names = [vm['name'] for vm in vms]
 
@@ -141,12 +145,13 @@ def do_create(env):
     new_names = []
 
     # Create and add the nodes
+    update = ravello.ApplicationUpdate(client, app)
     for i in range(count):
         name = util.unique_name_seqno('node{}', vm_names)
         vm_names.append(name)
         new_names.append(name)
         node = create_node(env, name)
-        app['design']['vms'].append(node)
+        update.add_vm(node)
         env.nodes.append(node)
 
     # Extend runtime to minimum runtime if needed.
@@ -158,7 +163,7 @@ def do_create(env):
         client.call('POST', '/applications/{id}/setExpiration'.format(**app), exp)
 
     # Now update application and publish updates. Do not start new nodes.
-    client.call('PUT', '/applications/{id}'.format(**app), app)
+    app = update.push()
     client.request('POST', '/applications/{id}/publishUpdates'
                            '?startAllDraftVms=false'.format(**app))
 
@@ -199,6 +204,7 @@ def dump_nodes(env):
     fname = os.path.expanduser(nodes_file)
     with open(fname, 'w') as fout:
         fout.write(json.dumps({'nodes': nodes}, sort_keys=True, indent=2))
+    nodedb.update_index(fname, nodes)
     print('Wrote {} nodes to `{}`.'.format(len(nodes), nodes_file))
 
 
@@ -242,21 +248,38 @@ def do_dump(env):
 # STOPPING, STOPPED -> OFF
 # STARTING, STARTED, UPDATING, RESTARTING -> ON
 
+def get_node_table(env):
+    """Return the node table of the proxy daemon, if it is available."""
+    table = env.node_table
+    if table is not None and table.is_fresh():
+        return table
+
+
+def update_node_table(env, nodename, **values):
+    """Record a change we made to *nodename* in the proxy daemon's node
+    table, if any."""
+    if env.node_table is not None:
+        env.node_table.update(nodename, **values)
+
+
 def do_list_running(env, virsh_format=False):
     """The `node-list command."""
-    for node in env.nodes[1:]:
+    table = get_node_table(env)
+    nodes = table.list_nodes() if table else env.nodes
+    # Nodes with a queued power action are reported in their intended state,
+    # so that Ironic does not see a power state change fail.
+    intended = env.power_queue.get_intended_states() if env.power_queue else {}
+    for node in nodes[1:]:
         name = node['name']
         if virsh_format:
             # Yes it needs quotes, unlike do_list_all().
             name = '"{}"'.format(name)
-        if node['state'] not in ('STOPPING', 'STOPPED'):
+        if intended.get(node['name'], node['state']) not in ('STOPPING', 'STOPPED'):
             sys.stdout.write('{}\n'.format(name))
 
 
 def do_list_all(env):
     """The `node-list --all` command."""
-    nodes_file = env.config['tripleo']['nodes_file']
-    fname = os.path.expanduser(nodes_file)
     # If we're called from the proxy try to use cached information from the
     # nodes file. We take this approach for `node-list --all` and also for
     # `get-node-macs` below. Ironic will refresh the power states for each node
@@ -269,62 +292,128 @@ def do_list_all(env):
     # The information for both API calls does not change unless someone first
     # adds a node and then dumps the info to the nodes file, and then imports
     # it in Ironic. So rather than contacting the API, we get the information
-    # from the nodes file directly, if it exists.
-    if env.args['--cached'] and util.try_stat(fname):
-        with open(fname) as fin:
-            nodes = json.loads(fin.read())['nodes']
+    # from the nodes file directly, if it exists. To avoid parsing the nodes
+    # file every time, we use the node index that is built from it.
+    index = nodedb.open_index(env) if env.args['--cached'] else None
+    if index is not None:
+        names = index.list_nodes()
+        index.close()
     else:
         # This is computed on attribute access. So we are actually preventing
         # the API calls if we don't access it.
-        nodes = env.nodes[1:]
+        names = [node['name'] for node in env.nodes[1:]]
+    for name in names:
+        sys.stdout.write('{}\n'.format(name))
+
+
+def get_node_info(vm, journal=None):
+    """Return the facts about node *vm* shown by `node-inventory`."""
+    conns = vm.get('networkConnections', [])
+    return {'name': vm['name'],
+            'state': vm['state'],
+            'macs': [mac for mac in map(ravello.get_mac, conns) if mac],
+            'ips': [ip for ip in map(ravello.get_ip, conns) if ip],
+            'boot_device': get_boot_device(vm, journal),
+            'cpus': vm['numCpus'],
+            'memory': ravello.convert_size(vm['memorySize'], 'MB'),
+            'disk': ravello.convert_size(get_disk(vm)['size'], 'GB')}
+
+
+def do_inventory(env, as_json=False):
+    """The `node-inventory` command."""
+    # All information comes from a single snapshot of the application, so
+    # the number of API calls does not depend on the number of nodes. These
+    # are a login (unless a cached session is reused), a lookup of the
+    # application ID (unless it is cached) and a GET of the application
+    # (unless a recent snapshot is cached).
+    journal = get_boot_journal(env, env.application)
+    nodes = [get_node_info(vm, journal) for vm in env.nodes[1:]]
+    if as_json:
+        print(json.dumps(nodes, sort_keys=True, indent=2))
+        return
+    template = '{:<16} {:<10} {:<8} {:>4} {:>8} {:>6}  {}'
+    print(template.format('Name', 'State', 'Boot', 'CPUs', 'Mem (MB)', 'Disk', 'MACs'))
     for node in nodes:
-        sys.stdout.write('{}\n'.format(node['name']))
+        print(template.format(node['name'], node['state'], node['boot_device'],
+                              node['cpus'], node['memory'], '{}G'.format(node['disk']),
+                              ', '.join(node['macs'])))
 
 
-def do_start(env, nodename):
-    """The `node-start` command."""
-    log = env.logger
-    app = env.application
-    # First extend runtime to min_runtime, if needed.
-    def extend_runtime():
+def wait_for_node(env, app, nodename, states):
+    """Wait until *nodename* is no longer in one of *states*. Return the
+    updated application."""
+    watcher = watch.VmWatcher(env, [nodename], app)
+    app = watcher.wait(lambda vm: vm['state'] not in states, ravello.time_left(1200))
+    times = watcher.get_times(nodename)
+    env.logger.debug('Node `{}` waited {:.2f} seconds.'.format(
+                        nodename, sum(times.get(state, 0) for state in states)))
+    return app
+
+
+def extend_runtime(env, app):
+    """Extend the runtime of *app* to `min_runtime`, if needed."""
+    def set_expiration():
         exp = {'expirationFromNowSeconds': min_runtime*60}
         env.client.call('POST', '/applications/{id}/setExpiration'.format(**app), exp)
+        factory.update_next_stop(env, app, int((time.time() + min_runtime*60) * 1000))
     nextstop = app.get('nextStopTime')
     min_runtime = env.config['ravello'].getint('min_runtime')
     if nextstop and nextstop/1000 < (time.time() + min_runtime*60):
         # This call should not fail even if vms are in a transient state.
-        log.debug('Expiration less than minimum requested, extending runtime.')
-        retry_operation(extend_runtime)
+        env.logger.debug('Expiration less than minimum requested, extending runtime.')
+        retry_operation(set_expiration)
+
+
+def do_start(env, nodename, app=None):
+    """The `node-start` command.
+
+    If *app* is specified, it is used as the initial state of the VM.
+    """
+    log = env.logger
+    if app is None:
+        app = factory.get_node_application(env, [nodename])
+    # First extend runtime to min_runtime, if needed.
+    extend_runtime(env, app)
     # Now start it up, taking into account the current vm state.
-    is_retry = [False]  # nonlocal
+    current = [app, False]  # nonlocal: application, is_retry
     def start_vm():
-        # Reload because someone else could have changed the application.
-        app = env.application
-        if is_retry[0]:
-            app = env.client.call('GET', '/applications/{id}'.format(**app))
-            env.application = app
-        is_retry[0] = True
+        # Reload because someone else could have changed the VM.
+        app, is_retry = current
+        if is_retry:
+            app = current[0] = factory.get_node_application(env, [nodename])
+        current[1] = True
         vm = get_vm(app, nodename)
         log.debug('Node `{name}` is in state `{state}`.'.format(**vm))
+        # STOPPING will result in STOPPED. Need to wait, cannot do anything right now.
+        if vm['state'] == 'STOPPING':
+            app = current[0] = wait_for_node(env, app, nodename, ('STOPPING',))
+            vm = get_vm(app, nodename)
         state = vm['state']
         # STARTED, or a transient state that will result in STARTED: done
         if state in ('STARTING', 'STARTED', 'RESTARTING', 'UPDATING'):
             return
-        # STOPPING will result in STOPPED. Need to wait, cannot do anything right now.
-        elif state == 'STOPPING':
-            raise ravello.Retry('Node in state `{}`'.format(state))
-        # Is there a scheduled change of boot device?
-        bootdev = get_next_boot_device(vm)
+        # Is there a scheduled change of boot device? It is applied with the
+        # same update that precedes the start.
+        journal = get_boot_journal(env, app)
+        bootdev = get_next_boot_device(vm, journal)
         if bootdev:
             log.debug('Updating boot device to `{}`.'.format(bootdev))
+            if 'design' not in app:
+                design = factory.get_node_application(env, [nodename], ('design',))
+                app['design'] = design['design']
+            update = ravello.ApplicationUpdate(env.client, app)
             design_vm = get_vm(app, nodename, 'design')
             set_current_boot_device(design_vm, bootdev)
             clear_next_boot_device(design_vm)
-            app = env.client.call('PUT', '/applications/{id}'.format(**app), app)
-            env.client.call('POST', '/applications/{id}/publishUpdates'.format(**app))
-            env.application = app
+            update.touch(design_vm)
+            if update.has_changes():
+                app = current[0] = update.push()
+                env.client.call('POST', '/applications/{id}/publishUpdates'.format(**app))
+            if journal:
+                journal.clear(nodename)
         env.client.call('POST', '/applications/{app[id]}/vms/{vm[id]}/start'
                                     .format(app=app, vm=vm))
+        return True
     # According to the docs, 400 means the application is in the middle of
     # another action, but I get 409 instead.
     # Retry just 3 times in case of HTTP errors. The start_vm function will not
@@ -332,48 +421,267 @@ def do_start(env, nodename):
     # STOPPING). The retries here are for race conditions where someone else
     # started up the VM concurrently.
     log.debug('Starting node `{}`.'.format(nodename))
-    retry_operation(start_vm, 1200, {400: 3, 403: 3, 409: 3})
+    # The node table is only updated if we started the VM. Otherwise the
+    # state it has from the last poll is more accurate.
+    if retry_operation(start_vm, 1200, {400: 3, 403: 3, 409: 3, 429: 5}):
+        update_node_table(env, nodename, state='STARTING')
+
 
+def do_stop(env, nodename, app=None):
+    """The `node-stop` command.
 
-def do_stop(env, nodename):
-    """The `node-stop` command."""
+    If *app* is specified, it is used as the initial state of the VM.
+    """
     log = env.logger
-    is_retry = [False]  # nonlocal
+    if app is None:
+        app = factory.get_node_application(env, [nodename])
+    current = [app, False]  # nonlocal
     def stop_vm():
-        app = env.application
-        if is_retry[0]:
-            app = env.client.call('GET', '/applications/{id}'.format(**app))
-            env.application = app
-        is_retry[0] = True
+        app, is_retry = current
+        if is_retry:
+            app = current[0] = factory.get_node_application(env, [nodename])
+        current[1] = True
         vm = get_vm(app, nodename)
         log.debug('Node `{name}` is in state `{state}`.'.format(**vm))
+        # These states will result in STARTED but prevent us from doing
+        # anything right now. So wait.
+        transient = ('STARTING', 'RESTARTING', 'UPDATING')
+        if vm['state'] in transient:
+            app = current[0] = wait_for_node(env, app, nodename, transient)
+            vm = get_vm(app, nodename)
         state = vm['state']
         # STOPPED, or STOPPING which will result in STOPPED: done
         if state in ('STOPPED', 'STOPPING'):
             return
-        # These states will result in STARTED but prevent us from doing
-        # anything right now. So wait.
-        elif state in ('STARTING', 'RESTARTING', 'UPDATING'):
-            raise ravello.Retry('Node in state `{}`'.format(state))
         # STARTED
         env.client.call('POST', '/applications/{app[id]}/vms/{vm[id]}/poweroff'
-                                    .format(app=env.application, vm=vm))
+                                    .format(app=app, vm=vm))
+        return True
     log.debug('Stopping node `{}`.'.format(nodename))
-    retry_operation(stop_vm, 1200, {400: 3, 403: 3, 409: 3})
+    if retry_operation(stop_vm, 1200, {400: 3, 403: 3, 409: 3, 429: 5}):
+        update_node_table(env, nodename, state='STOPPING')
 
 
-def do_reboot(env, nodename):
-    """The `node-reboot` command."""
-    do_stop(env, nodename)
-    del env.application  # re-init it with the correct VM state
-    do_start(env, nodename)
+def needs_power_cycle(env, app, nodename):
+    """Return whether rebooting *nodename* needs a stop and a start, rather
+    than a restart. This is the case if the VM is not running, or if it has
+    a pending boot device change, which can only be applied while it is off."""
+    vm = get_vm(app, nodename)
+    return vm['state'] != 'STARTED' or bool(get_next_boot_device(vm, get_boot_journal(env, app)))
+
+
+def do_reboot(env, nodename, app=None):
+    """The `node-reboot` command.
+
+    If *app* is specified, it is used as the initial state of the VM.
+    """
+    log = env.logger
+    if app is None:
+        app = factory.get_node_application(env, [nodename])
+    if needs_power_cycle(env, app, nodename):
+        do_stop(env, nodename, app)
+        do_start(env, nodename)  # reloads the application with the correct VM state
+        return
+    extend_runtime(env, app)
+    current = [app, False, False]  # nonlocal: application, is_retry, stopped
+    def restart_vm():
+        app, is_retry, _ = current
+        if is_retry:
+            app = current[0] = factory.get_node_application(env, [nodename])
+        current[1] = True
+        vm = get_vm(app, nodename)
+        log.debug('Node `{name}` is in state `{state}`.'.format(**vm))
+        if vm['state'] == 'UPDATING':
+            app = current[0] = wait_for_node(env, app, nodename, ('UPDATING',))
+            vm = get_vm(app, nodename)
+        state = vm['state']
+        # Already booting: done
+        if state in ('STARTING', 'RESTARTING'):
+            return
+        # Someone else stopped it in the mean time. It needs to be started.
+        elif state != 'STARTED':
+            current[2] = True
+            return
+        env.client.call('POST', '/applications/{app[id]}/vms/{vm[id]}/restart'
+                                    .format(app=app, vm=vm))
+        return True
+    log.debug('Restarting node `{}`.'.format(nodename))
+    restarted = retry_operation(restart_vm, 1200, {400: 3, 403: 3, 409: 3, 429: 5})
+    if current[2]:
+        do_start(env, nodename)
+    elif restarted:
+        update_node_table(env, nodename, state='RESTARTING')
+
+
+def queue_power_action(env, nodename, action):
+    """Queue power *action* for *nodename* in the proxy daemon's power queue.
+
+    The action is performed in the background by the daemon.
+    """
+    table = get_node_table(env)
+    if table and table.get(nodename) is None:
+        raise RuntimeError('Application `{}` unknown vm `{}`.'
+                                .format(env.config.require('ravello', 'application'), nodename))
+    queued = env.power_queue.submit(nodename, action)
+    env.logger.debug('Queued action `{}` for node `{}`.'.format(queued, nodename))
+    METRICS.increment('power_actions_queued')
+
+
+# Group power actions. These act on many nodes at once, for example to bring
+# up an entire overcloud. A single snapshot of the application is shared, the
+# pending boot device changes are applied with a single update, and the nodes
+# are then started or stopped in parallel. The result for each node is
+# reported as soon as it is available.
+
+_re_glob = re.compile('[*?[]')
+
+def expand_nodenames(env, patterns, all_nodes=False):
+    """Return the names of the nodes matching *patterns*, which may contain
+    shell style wildcards, or of all nodes if *all_nodes* is set."""
+    if not all_nodes and not any(_re_glob.search(pattern) for pattern in patterns):
+        return list(util.unique(patterns))
+    names = [node['name'] for node in env.nodes[1:]]
+    if all_nodes:
+        return names
+    nodenames = []
+    for pattern in patterns:
+        if not _re_glob.search(pattern):
+            nodenames.append(pattern)
+            continue
+        matched = fnmatch.filter(names, pattern)
+        if not matched:
+            raise RuntimeError('No nodes match `{}`.'.format(pattern))
+        nodenames.extend(matched)
+    return list(util.unique(nodenames))
+
+
+def run_group(env, nodenames, action, verb):
+    """Run ``action(nodename)`` for all *nodenames* in parallel, and report
+    the result for each node as it completes."""
+    size = min(env.config['ravello'].getint('max_parallel'), len(nodenames))
+    pool = parallel.get_pool(env.client, size)
+    failed = 0
+    try:
+        for future in pool.imap_unordered(action, nodenames):
+            nodename, error = future.args[0], future.exception()
+            if error is not None:
+                env.logger.error('Node `{}` failed: {!s}'.format(nodename, error))
+                print('{}: failed: {!s}'.format(nodename, error))
+                failed += 1
+            elif verb:
+                print('{}: {}'.format(nodename, verb))
+            sys.stdout.flush()
+    finally:
+        pool.close()
+    if failed:
+        raise RuntimeError('{} out of {} nodes failed.'.format(failed, len(nodenames)))
+
+
+def apply_pending_boot_devices(env, app, nodenames):
+    """Apply the pending boot device changes for *nodenames* with a single
+    update. Return whether the application was updated."""
+    journal = get_boot_journal(env, app)
+    pending = [(nodename, get_next_boot_device(get_vm(app, nodename), journal))
+               for nodename in nodenames]
+    pending = [(nodename, bootdev) for nodename, bootdev in pending if bootdev]
+    if not pending:
+        return False
+    update = ravello.ApplicationUpdate(env.client, app)
+    for nodename, bootdev in pending:
+        env.logger.debug('Updating boot device for `{}` to `{}`.'.format(nodename, bootdev))
+        design_vm = get_vm(app, nodename, 'design')
+        set_current_boot_device(design_vm, bootdev)
+        clear_next_boot_device(design_vm)
+        update.touch(design_vm)
+    def push_update():
+        app = update.push()
+        env.client.call('POST', '/applications/{id}/publishUpdates'.format(**app))
+    updated = update.has_changes()
+    if updated:
+        retry_operation(push_update, 1200, {400: 3, 403: 3, 409: 3, 429: 5})
+    if journal:
+        for nodename, _ in pending:
+            journal.clear(nodename)
+    return updated
+
+
+def start_nodes(env, nodenames, verb='started'):
+    """Start *nodenames*."""
+    app = factory.refresh_application(env)
+    for nodename in nodenames:
+        get_vm(app, nodename)
+    extend_runtime(env, app)
+    # Boot devices can only be changed once the VMs are stopped.
+    stopping = [nodename for nodename in nodenames
+                if get_vm(app, nodename)['state'] == 'STOPPING']
+    if stopping:
+        watcher = watch.VmWatcher(env, stopping, app)
+        watcher.wait(lambda vm: vm['state'] != 'STOPPING', ravello.time_left(1200))
+        app = factory.refresh_application(env)
+    stopped = [nodename for nodename in nodenames
+               if get_vm(app, nodename)['state'] == 'STOPPED']
+    if apply_pending_boot_devices(env, app, stopped):
+        app = factory.refresh_application(env)
+    run_group(env, nodenames, lambda nodename: do_start(env, nodename, app), verb)
+
+
+def stop_nodes(env, nodenames, verb='stopped'):
+    """Stop *nodenames*."""
+    app = factory.refresh_application(env)
+    for nodename in nodenames:
+        get_vm(app, nodename)
+    run_group(env, nodenames, lambda nodename: do_stop(env, nodename, app), verb)
+
+
+def reboot_nodes(env, nodenames):
+    """Reboot *nodenames*."""
+    app = factory.refresh_application(env)
+    cycle = [nodename for nodename in nodenames if needs_power_cycle(env, app, nodename)]
+    restart = [nodename for nodename in nodenames if nodename not in cycle]
+    errors = []
+    if restart:
+        try:
+            run_group(env, restart, lambda nodename: do_reboot(env, nodename, app), 'rebooted')
+        except RuntimeError as e:
+            errors.append(str(e))
+    if cycle:
+        try:
+            stop_nodes(env, cycle, None)
+            start_nodes(env, cycle, 'rebooted')
+        except RuntimeError as e:
+            errors.append(str(e))
+    if errors:
+        raise RuntimeError(' '.join(errors))
+
+
+def do_group_action(env, action, patterns, all_nodes=False):
+    """The `node-start`, `node-stop` and `node-reboot` commands."""
+    nodenames = expand_nodenames(env, patterns, all_nodes)
+    if not nodenames:
+        raise RuntimeError('No nodes to {}.'.format(action))
+    single = {'start': do_start, 'stop': do_stop, 'reboot': do_reboot}
+    group = {'start': start_nodes, 'stop': stop_nodes, 'reboot': reboot_nodes}
+    if len(nodenames) == 1:
+        single[action](env, nodenames[0])
+    else:
+        group[action](env, nodenames)
 
 
 # Boot device stuff. This is somewhat complicated. Changing the boot device on
 # Ravello will restart a VM. Ironic does not expect that. So we use a hack
 # whereby if a boot device change is requested while a VM is not in the STOPPED
-# state, that we "queue" this change into the VM's description and execute it
-# only at the next power change.
+# state, that we "queue" this change and execute it only at the next power
+# change. Pending changes are stored in a journal in the runtime directory.
+# Previous versions stored them in the VM's description, which needs an update
+# of the application. That is still used if there is no runtime directory, and
+# pending changes in the description are still honored.
+
+def get_boot_journal(env, app):
+    """Return the boot device journal for *app*, or ``None``."""
+    rtdir = runtime.get_runtime_dir()
+    if rtdir:
+        return journal.BootDeviceJournal(os.path.join(rtdir, 'bootdev.json'), app['id'])
+
 
 def get_current_boot_device(vm):
     """Return the current boot device for a VM."""
@@ -388,38 +696,49 @@ def set_current_boot_device(vm, bootdev):
 
 _re_bootdev = re.compile('\\[boot: (hd|network)\\]')
 
-def get_next_boot_device(vm):
+def get_next_boot_device(vm, journal=None):
     """Return the next boot device for a VM, if any."""
+    if journal:
+        bootdev = journal.get(vm['name'])
+        if bootdev:
+            return bootdev
     # Yes, we do indeed abuse the "description" field for this...
     desc = vm.get('description', '')
     match = _re_bootdev.search(desc)
     return match.group(1) if match else None
 
-def set_next_boot_device(vm, bootdev):
-    """Schedule a boot device change."""
+def set_next_boot_device(vm, bootdev, journal=None):
+    """Schedule a boot device change. Return whether *vm* was changed."""
+    if journal:
+        journal.set(vm['name'], bootdev)
+        return clear_next_boot_device(vm)
     desc = vm.get('description', '')
     match = _re_bootdev.search(desc)
     current = match.group(1) if match else None
     if current == bootdev:
-        return
+        return False
     if current:
         desc = desc[:match.start(0)] + desc[match.end(0)+1:]
     desc += '[boot: {}]'.format(bootdev)
     vm['description'] = desc
+    return True
 
-def clear_next_boot_device(vm):
-    """Clear any pending boot device change."""
+def clear_next_boot_device(vm, journal=None):
+    """Clear any pending boot device change. Return whether *vm* was changed."""
+    if journal:
+        journal.clear(vm['name'])
     desc = vm.get('description', '')
     match = _re_bootdev.search(desc)
     if not match:
-        return
+        return False
     desc = desc[:match.start(0)] + desc[match.end(0)+1:]
     vm['description'] = desc
+    return True
 
 
-def get_boot_device(vm):
+def get_boot_device(vm, journal=None):
     """Get the effective boot device."""
-    bootdev = get_next_boot_device(vm)
+    bootdev = get_next_boot_device(vm, journal)
     if bootdev is None:
         bootdev = get_current_boot_device(vm)
     return bootdev
@@ -427,61 +746,120 @@ def get_boot_device(vm):
 
 def do_get_boot_device(env, nodename):
     """The `node-get-boot-device` command."""
-    vm = get_vm(env.application, nodename)
-    bootdev = get_boot_device(vm)
+    # The proxy daemon keeps the boot device in its node table, and shares a
+    # recent snapshot between read-only commands. Otherwise, loading just this
+    # VM is much cheaper than the application.
+    table = get_node_table(env)
+    entry = table.get(nodename) if table else None
+    if entry is not None:
+        print(entry['bootdev'])
+        return
+    if env.shared_snapshot:
+        app = env.application
+    else:
+        app = factory.get_node_application(env, [nodename])
+    vm = get_vm(app, nodename)
+    bootdev = get_boot_device(vm, get_boot_journal(env, app))
     print(bootdev)
 
 
-def do_set_boot_device(env, nodename, bootdev):
-    """Set the boot device for *nodename* to *bootdev*."""
+def update_boot_device(env, app, nodename, bootdev):
+    """Update the design of *app* to set the boot device for *nodename* to
+    *bootdev*. Return whether the application was changed."""
     log = env.logger
-    is_retry = [False]  # nonlocal
-    def set_boot_device():
-        app = env.application
-        if is_retry[0]:
-            app = env.client.call('GET', '/applications/{id}'.format(**app))
-            env.application = app
-        is_retry[0] = True
-        vm = get_vm(app, nodename)
-        current = get_boot_device(vm)
-        if current == bootdev:
-            log.debug('Boot device already set to `{}`.'.format(bootdev))
+    journal = get_boot_journal(env, app)
+    vm = get_vm(app, nodename)
+    current = get_boot_device(vm, journal)
+    if current == bootdev:
+        log.debug('Boot device for `{}` already set to `{}`.'.format(nodename, bootdev))
+        return False
+    state = vm['state']
+    design_vm = get_vm(app, nodename, 'design')
+    # Is it a matter of removing the next boot device?
+    if get_current_boot_device(vm) == bootdev:
+        log.debug('Clearing next boot device for `{}`.'.format(nodename))
+        return clear_next_boot_device(design_vm, journal)
+    # Nope: need to updated the real boot device.
+    # We can do this when state == STOPPED.
+    elif state == 'STOPPED':
+        set_current_boot_device(design_vm, bootdev)
+        clear_next_boot_device(design_vm, journal)
+        log.debug('Setting current boot device for `{}` to `{}`.'.format(nodename, bootdev))
+        return True
+    # Need to queue the boot device change. With the journal this does not
+    # need an update of the application.
+    else:
+        log.debug('Setting next boot device for `{}` to `{}`.'.format(nodename, bootdev))
+        return set_next_boot_device(design_vm, bootdev, journal)
+
+
+def set_boot_devices(env, changes):
+    """Set the boot devices for a list of ``(nodename, bootdev)`` tuples with
+    a single update of the application.
+
+    Return a list with an error message, or ``None`` for success, for each
+    change.
+    """
+    nodenames = sorted(set(nodename for nodename, _ in changes))
+    errors = [None] * len(changes)
+    def update_application():
+        app = factory.get_node_application(env, nodenames, ('deployment', 'design'))
+        update = ravello.ApplicationUpdate(env.client, app)
+        for ix, (nodename, bootdev) in enumerate(changes):
+            try:
+                if update_boot_device(env, app, nodename, bootdev):
+                    update.touch(get_vm(app, nodename, 'design'))
+                errors[ix] = None
+            except RuntimeError as e:
+                errors[ix] = str(e)
+        if not update.has_changes():
             return
-        state = vm['state']
-        design_vm = get_vm(app, nodename, 'design')
-        # Is it a matter of removing the next boot device?
-        if get_current_boot_device(vm) == bootdev:
-            clear_next_boot_device(design_vm)
-            log.debug('Clearing next boot device.')
-        # Nope: need to updated the real boot device.
-        # We can do this when state == STOPPED.
-        elif state == 'STOPPED':
-            set_current_boot_device(design_vm, bootdev)
-            clear_next_boot_device(design_vm)
-            log.debug('Setting current boot device to `{}`.'.format(bootdev))
-        # Need to queue the boot device change.
-        else:
-            set_next_boot_device(design_vm, bootdev)
-            log.debug('Setting next boot device to `{}`.'.format(bootdev))
-        app = env.client.call('PUT', '/applications/{id}'.format(**app), app)
+        app = update.push()
         env.client.call('POST', '/applications/{id}/publishUpdates'.format(**app))
-        env.application = app
+    retry_operation(update_application, 1200, {400: 3, 403: 3, 409: 3, 429: 5})
+    return errors
+
+
+def apply_boot_device_changes(env, changes):
+    """Apply a batch of boot device changes from the change queue."""
+    errors = set_boot_devices(env, [(c['node'], c['bootdev']) for c in changes])
+    return {c['id']: error for c, error in zip(changes, errors)}
+
+
+def do_set_boot_device(env, nodename, bootdev):
+    """Set the boot device for *nodename* to *bootdev*."""
+    log = env.logger
     log.debug('Setting boot device for node `{}` to `{}`'.format(nodename, bootdev))
-    retry_operation(set_boot_device, 1200, {400: 3, 403: 3, 409: 3})
+    # When a node is deployed, Ironic changes its boot device twice. If many
+    # nodes are deployed at once, the changes that are made while another one
+    # is being applied are coalesced into a single update of the application.
+    # Without this they would all conflict.
+    window = env.config['proxy'].getfloat('coalesce_window')
+    rtdir = runtime.get_runtime_dir()
+    if rtdir:
+        queue = coalesce.ChangeQueue(rtdir, 'bootdev')
+        appname = env.config.require('ravello', 'application')
+        change = {'node': nodename, 'bootdev': bootdev}
+        queue.submit(appname, change, lambda c: apply_boot_device_changes(env, c), window)
+    else:
+        error = set_boot_devices(env, [(nodename, bootdev)])[0]
+        if error:
+            raise RuntimeError(error)
+    update_node_table(env, nodename, bootdev=bootdev)
 
 
 def do_get_macs(env, nodename, virsh_format=False):
     """The `node-get-macs` command."""
-    nodes_file = env.config['tripleo']['nodes_file']
-    fname = os.path.expanduser(nodes_file)
     # See the note in do_list_all on why we're using cached information.
     macs = []
-    if env.args['--cached'] and util.try_stat(fname):
-        with open(fname) as fin:
-            nodes = json.loads(fin.read())['nodes']
-        for node in nodes:
-            if node['name'] == nodename:
-                macs += node['mac']
+    index = nodedb.open_index(env) if env.args['--cached'] else None
+    table = get_node_table(env)
+    entry = table.get(nodename) if table else None
+    if index is not None:
+        macs = index.get_macs(nodename)
+        index.close()
+    elif entry is not None:
+        macs = entry['macs']
     else:
         vm = get_vm(env.application, nodename)
         for conn in vm.get('networkConnections', []):
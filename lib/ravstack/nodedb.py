@@ -0,0 +1,178 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import sqlite3
+import tempfile
+
+from . import util, runtime
+from .runtime import LOG
+
+# The node index is a small SQLite database in the runtime directory that is
+# built from the nodes file. The proxy uses it to look up nodes by name or by
+# MAC address. Unlike the nodes file, it does not contain the power management
+# credentials, which are a copy of the proxy's private key for every node.
+#
+# The index records the modification time and size of the nodes file it was
+# built from, and is rebuilt automatically when the nodes file changes. A new
+# index is written to a temporary file and renamed into place, so readers
+# never see a partial index.
+#
+# This module is used by the proxy, so it must only use the stdlib.
+
+_schema = """
+    CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+    CREATE TABLE nodes (seq INTEGER PRIMARY KEY, name TEXT UNIQUE, arch TEXT,
+                        cpu TEXT, memory TEXT, disk TEXT);
+    CREATE TABLE macs (key TEXT PRIMARY KEY, mac TEXT, name TEXT, seq INTEGER);
+    CREATE INDEX macs_name ON macs (name);
+"""
+
+_node_fields = ('name', 'arch', 'cpu', 'memory', 'disk')
+
+
+def get_index_name():
+    """Return the name of the node index, or ``None``."""
+    rtdir = runtime.get_runtime_dir()
+    if rtdir:
+        return os.path.join(rtdir, 'nodes.db')
+
+
+def get_stamp(fname, st):
+    """Return the stamp identifying version *st* of nodes file *fname*."""
+    return '{} {} {}'.format(fname, st.st_mtime, st.st_size)
+
+
+def create_index(db, nodes, stamp):
+    """Populate the empty database *db* with *nodes*."""
+    db.executescript(_schema)
+    db.execute('INSERT INTO meta VALUES (?, ?)', ('stamp', stamp))
+    for seq, node in enumerate(nodes):
+        db.execute('INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?)',
+                   (seq,) + tuple(node.get(field) for field in _node_fields))
+        for ix, mac in enumerate(node.get('mac', [])):
+            db.execute('INSERT OR REPLACE INTO macs VALUES (?, ?, ?, ?)',
+                       (mac.lower(), mac, node['name'], ix))
+    db.commit()
+
+
+def write_index(dbname, nodes, stamp):
+    """Write a new node index *dbname*."""
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(dbname), prefix='.nodes-')
+    os.close(fd)
+    try:
+        db = sqlite3.connect(tmpname)
+        try:
+            create_index(db, nodes, stamp)
+        finally:
+            db.close()
+        os.rename(tmpname, dbname)
+    except Exception:
+        util.try_unlink(tmpname)
+        raise
+
+
+def read_nodes_file(fname):
+    """Read the nodes from the nodes file, without the power management
+    credentials."""
+    with open(fname) as fin:
+        nodes = json.loads(fin.read())['nodes']
+    return [util.filter_dict(node, 'mac', *_node_fields) for node in nodes]
+
+
+class NodeIndex(object):
+    """An index of the nodes in the nodes file."""
+
+    def __init__(self, db):
+        self._db = db
+
+    def close(self):
+        self._db.close()
+
+    def get_stamp(self):
+        """Return the stamp of the nodes file this index was built from."""
+        row = self._db.execute("SELECT value FROM meta WHERE key = 'stamp'").fetchone()
+        return row[0] if row else None
+
+    def list_nodes(self):
+        """Return the names of all nodes, in nodes file order."""
+        return [row[0] for row in self._db.execute('SELECT name FROM nodes ORDER BY seq')]
+
+    def get_node(self, name):
+        """Return the node *name*, or ``None`` if it does not exist."""
+        row = self._db.execute('SELECT {} FROM nodes WHERE name = ?'
+                                    .format(', '.join(_node_fields)), (name,)).fetchone()
+        if row is None:
+            return
+        node = dict(zip(_node_fields, row))
+        node['mac'] = self.get_macs(name)
+        return node
+
+    def get_macs(self, name):
+        """Return the MAC addresses of node *name*."""
+        return [row[0] for row in self._db.execute(
+                        'SELECT mac FROM macs WHERE name = ? ORDER BY seq', (name,))]
+
+    def find_node(self, mac):
+        """Return the name of the node with MAC address *mac*, or ``None``."""
+        row = self._db.execute('SELECT name FROM macs WHERE key = ?',
+                               (mac.lower(),)).fetchone()
+        return row[0] if row else None
+
+
+def _open_current(dbname, stamp):
+    """Open the index *dbname* if it exists and matches *stamp*."""
+    if not util.try_stat(dbname):
+        return
+    index = NodeIndex(sqlite3.connect(dbname))
+    try:
+        if index.get_stamp() == stamp:
+            return index
+    except sqlite3.Error as e:
+        LOG.debug('ignoring unusable node index: {!s}'.format(e))
+    index.close()
+
+
+def open_index(env):
+    """Return the index for the nodes file, or ``None`` if there is no nodes
+    file. The index is (re)built if needed."""
+    fname = os.path.expanduser(env.config['tripleo']['nodes_file'])
+    st = util.try_stat(fname)
+    if st is None:
+        return
+    stamp = get_stamp(fname, st)
+    dbname = get_index_name()
+    if dbname is None:
+        # No runtime directory: use a throwaway in-memory index.
+        db = sqlite3.connect(':memory:')
+        create_index(db, read_nodes_file(fname), stamp)
+        return NodeIndex(db)
+    index = _open_current(dbname, stamp)
+    if index is not None:
+        return index
+    with util.lock_file(dbname + '.lock'):
+        # Another process may have rebuilt it while we waited for the lock.
+        index = _open_current(dbname, stamp)
+        if index is None:
+            LOG.debug('building node index for `{}`.'.format(fname))
+            write_index(dbname, read_nodes_file(fname), stamp)
+            index = _open_current(dbname, stamp)
+    return index
+
+
+def update_index(fname, nodes):
+    """Update the index after writing *nodes* to nodes file *fname*."""
+    dbname = get_index_name()
+    if dbname is None:
+        return
+    nodes = [util.filter_dict(node, 'mac', *_node_fields) for node in nodes]
+    with util.lock_file(dbname + '.lock'):
+        write_index(dbname, nodes, get_stamp(fname, os.stat(fname)))
@@ -0,0 +1,172 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import sys
+import logging
+import threading
+
+import six
+from six.moves import queue
+
+from . import ravello, trace
+
+LOG = logging.getLogger(__name__)
+
+# A bounded pool of worker threads to make independent API calls concurrently.
+# The wall time of a set of calls is then about that of the slowest one. The
+# API client is a `requests.Session`, which can be used from multiple threads;
+# its connection pool is sized to the number of workers.
+#
+# Work submitted to the pool is run in the trace and under the retry deadline
+# of the submitting thread.
+#
+# This uses threads rather than asyncio. The API client, and the caches, rate
+# limiter and circuit breaker around it, are built on the blocking `requests`
+# library, as is all code that calls the API. An asyncio client would need a
+# different HTTP library and an async variant of each of these.
+
+
+class Future(object):
+    """The result of work submitted to a :class:`WorkerPool`."""
+
+    def __init__(self, func, args, kwargs):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def _run(self):
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+        self._done.set()
+
+    def done(self):
+        """Return whether the work has completed."""
+        return self._done.is_set()
+
+    def exception(self):
+        """Wait for the work to complete and return its exception, if any."""
+        self._done.wait()
+        return self._exc_info[1] if self._exc_info else None
+
+    def result(self):
+        """Wait for the work to complete and return its result. If it raised
+        an exception, the exception is re-raised."""
+        self._done.wait()
+        if self._exc_info:
+            six.reraise(*self._exc_info)
+        return self._result
+
+
+class WorkerPool(object):
+    """A pool of at most *size* worker threads."""
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._queue = queue.Queue()
+        self._workers = []
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def _worker(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            future, state, deadline, done = item
+            with trace.attach(state):
+                ravello.set_deadline(deadline)
+                try:
+                    future._run()
+                finally:
+                    ravello.set_deadline(None)
+            with self._lock:
+                self._pending -= 1
+            if done is not None:
+                done.put(future)
+
+    def submit(self, func, *args, **kwargs):
+        """Run ``func(*args, **kwargs)`` in a worker and return a
+        :class:`Future`."""
+        return self._submit(None, func, args, kwargs)
+
+    def _submit(self, done, func, args, kwargs):
+        future = Future(func, args, kwargs)
+        with self._lock:
+            self._pending += 1
+            if self._pending > len(self._workers) and len(self._workers) < self.size:
+                worker = threading.Thread(target=self._worker, name='worker')
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+        self._queue.put((future, trace.capture(), ravello.get_deadline(), done))
+        return future
+
+    def imap_unordered(self, func, items):
+        """Run ``func(item)`` for each item in *items*. Yield the futures as
+        they complete."""
+        done = queue.Queue()
+        futures = [self._submit(done, func, (item,), {}) for item in items]
+        for _ in futures:
+            yield done.get()
+
+    def map(self, func, items):
+        """Run ``func(item)`` for each item in *items*, and return the results
+        in order. The first exception, if any, is re-raised after all work
+        completed."""
+        futures = [self.submit(func, item) for item in items]
+        for future in futures:
+            future.exception()
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Stop the workers once all submitted work is done."""
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+
+def get_pool(client, size):
+    """Return a worker pool of *size* threads for making calls with
+    *client*."""
+    client.set_pool_size(size)
+    return WorkerPool(size)
+
+
+def call_many(client, calls, size=None):
+    """Make the API calls in *calls* concurrently, and return their results in
+    order. Each call is a ``(method, url)`` or ``(method, url, body)`` tuple."""
+    if len(calls) <= 1:
+        return [client.call(*call) for call in calls]
+    pool = get_pool(client, size or len(calls))
+    try:
+        return pool.map(lambda call: client.call(*call), calls)
+    finally:
+        pool.close()
+
+
+def retry_many(client, funcs, timeout=60, retries=None, size=None):
+    """Concurrent counterpart of :func:`ravello.retry_operation`. Retry each
+    function in *funcs* with its own policy, and return the results in order.
+    The first exception, if any, is re-raised after all operations
+    completed."""
+    if len(funcs) <= 1:
+        return [ravello.retry_operation(func, timeout, retries) for func in funcs]
+    pool = get_pool(client, size or len(funcs))
+    try:
+        return pool.map(lambda func: ravello.retry_operation(func, timeout, retries), funcs)
+    finally:
+        pool.close()
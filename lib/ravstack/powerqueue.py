@@ -0,0 +1,115 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import random
+
+from . import util
+
+# The power queue is used by the proxy daemon in "write-behind" mode. Power
+# actions requested by Ironic are recorded in the queue and the command
+# returns right away. A worker in the daemon then drives each VM to the
+# requested state, with retries. Without this, Ironic's conductor blocks while
+# a VM is in a transient state or the application is locked, sometimes for
+# longer than its timeout.
+#
+# The queue is a JSON file in the runtime directory, so pending actions
+# survive a restart of the daemon. There is at most one pending action per
+# node: a new request is merged with the pending one.
+
+# The action that results from requesting an action (the key) while another
+# action is pending (the second key). The latest request wins, except that a
+# power cycle is never lost: a start or reboot of a node that is going to be
+# stopped, and a start of a node that is going to be rebooted, become a
+# reboot. Ironic powers a node off, changes its boot device and powers it on
+# again, and the boot device change is only applied while the node is off.
+# A reboot of a node that is already off just starts it.
+_merged = {('start', 'stop'): 'reboot',
+           ('reboot', 'stop'): 'reboot',
+           ('start', 'reboot'): 'reboot'}
+
+_intended_states = {'start': 'STARTED', 'stop': 'STOPPED', 'reboot': 'STARTED'}
+
+
+def new_id():
+    """Return a unique ID for a queue entry."""
+    return '{}-{:016x}'.format(os.getpid(), random.getrandbits(64))
+
+
+class PowerQueue(object):
+    """A durable queue of power actions for application *appname*."""
+
+    # An action is given up after this many failed attempts. The retries of
+    # each attempt are done by the action itself.
+    max_attempts = 5
+    max_delay = 60
+
+    def __init__(self, dirname, appname):
+        self.fname = os.path.join(dirname, 'power-queue.json')
+        self.appname = appname
+
+    def _update(self, func):
+        with util.lock_file(self.fname + '.lock'):
+            queue = util.read_json_file(self.fname, {})
+            nodes = queue.setdefault(self.appname, {})
+            result = func(nodes)
+            if not nodes:
+                del queue[self.appname]
+            util.write_file_atomic(self.fname, json.dumps(queue, sort_keys=True))
+        return result
+
+    def _get_nodes(self):
+        return util.read_json_file(self.fname, {}).get(self.appname, {})
+
+    def submit(self, nodename, action):
+        """Request *action* for *nodename*. Return the resulting action."""
+        def submit(nodes):
+            pending = nodes.get(nodename)
+            merged = _merged.get((action, pending['action']), action) if pending else action
+            nodes[nodename] = {'action': merged, 'id': new_id(), 'time': time.time(),
+                               'attempts': 0, 'next_try': 0}
+            return merged
+        return self._update(submit)
+
+    def get_pending(self):
+        """Return the pending entries, as a dictionary by node name."""
+        return self._get_nodes()
+
+    def get_intended_states(self):
+        """Return the states the nodes with a pending action will end up in."""
+        return {nodename: _intended_states[entry['action']]
+                for nodename, entry in self._get_nodes().items()}
+
+    def complete(self, nodename, entry_id):
+        """Remove entry *entry_id* for *nodename* after it completed. Nothing
+        is done if a new request was made in the mean time."""
+        def complete(nodes):
+            if nodes.get(nodename, {}).get('id') == entry_id:
+                del nodes[nodename]
+        self._update(complete)
+
+    def fail(self, nodename, entry_id, error):
+        """Record that entry *entry_id* for *nodename* failed with *error*.
+        Return whether it will be retried."""
+        def fail(nodes):
+            entry = nodes.get(nodename)
+            if entry is None or entry['id'] != entry_id:
+                return True
+            entry['attempts'] += 1
+            entry['error'] = error
+            if entry['attempts'] >= self.max_attempts:
+                del nodes[nodename]
+                return False
+            delay = min(self.max_delay, 2 ** entry['attempts'])
+            entry['next_try'] = time.time() + delay * (0.5 + random.random())
+            return True
+        return self._update(fail)
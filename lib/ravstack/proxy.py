@@ -9,14 +9,23 @@
 from __future__ import absolute_import, print_function
 
 import os
+import sys
+import json
+import errno
+import socket
 import shlex
 import subprocess
 import textwrap
 import re
 
-from . import util, factory, node, runtime
+from . import util, runtime, trace
 from .runtime import LOG, CONF
 
+# This module is executed for every virsh command issued by Ironic. It is
+# therefore kept free of any non-stdlib imports. The modules that need the
+# `requests` module are only imported if there is no proxy daemon to forward
+# the command to.
+
 
 # proxy-create command
 
@@ -133,6 +142,79 @@ def parse_virsh_command_line(command):
     raise RuntimeError('unrecognized command: {}'.format(command))
 
 
+# Commands that only read state. These can be served from a recent snapshot of
+# the application by the proxy daemon.
+readonly_commands = ('true', 'list_running', 'list_all', 'get_boot_device',
+                     'get_node_macs')
+
+# Power commands. These are queued by the proxy daemon in write-behind mode.
+power_commands = ('start', 'stop', 'reboot')
+
+
+def run_command(env, cmdline):
+    """Run a parsed virsh command line."""
+    from . import node
+    if cmdline[0] == 'true':
+        pass
+    elif cmdline[0] == 'start':
+        node.do_start(env, cmdline[1])
+    elif cmdline[0] == 'stop':
+        node.do_stop(env, cmdline[1])
+    elif cmdline[0] == 'reboot':
+        node.do_reboot(env, cmdline[1])
+    elif cmdline[0] == 'list_running':
+        node.do_list_running(env, True)
+    elif cmdline[0] == 'list_all':
+        node.do_list_all(env)
+    elif cmdline[0] == 'get_boot_device':
+        node.do_get_boot_device(env, cmdline[1])
+    elif cmdline[0] == 'set_boot_device':
+        node.do_set_boot_device(env, cmdline[2], cmdline[1])
+    elif cmdline[0] == 'get_node_macs':
+        node.do_get_macs(env, cmdline[1], True)
+
+
+def get_socket_name():
+    """Return the name of the proxy daemon's socket, or ``None``."""
+    rtdir = runtime.get_runtime_dir()
+    if rtdir:
+        return os.path.join(rtdir, 'proxy.sock')
+
+
+def forward_command(command, context):
+    """Forward a command to the proxy daemon.
+
+    Return a ``(output, error)`` tuple, or ``None`` if the daemon is not
+    running.
+    """
+    sockname = get_socket_name()
+    if not sockname or not util.try_stat(sockname):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        try:
+            sock.connect(sockname)
+        except socket.error as e:
+            if e.args[0] not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+            LOG.debug('Proxy daemon not running: {!s}'.format(e))
+            return
+        sp = trace.current()
+        request = {'command': command, 'context': context,
+                   'trace': sp.trace_id if sp else None}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        chunks = []
+        while True:
+            buf = sock.recv(65536)
+            if not buf:
+                break
+            chunks.append(buf)
+    finally:
+        sock.close()
+    response = json.loads(b''.join(chunks).decode('utf-8'))
+    return response['output'], response['error']
+
+
 def main():
     """Proxy main function."""
     args = {'--cached': True}
@@ -153,27 +235,22 @@ def main():
     LOG.debug('New request, command = {}'.format(command))
     cmdline = parse_virsh_command_line(command)
     LOG.info('Parsed command: {}'.format(' '.join(cmdline)))
+    trace.annotate(command=' '.join(cmdline))
 
-    env = factory.get_environ(args)
+    # If the proxy daemon is running, let it do the work. It has a logged-in
+    # API client and a warm snapshot of the application.
+    with trace.span('forward'):
+        response = forward_command(command, context)
+    if response is not None:
+        output, error = response
+        sys.stdout.write(output)
+        if error:
+            raise RuntimeError(error)
+        return
 
-    if cmdline[0] == 'true':
-        pass
-    elif cmdline[0] == 'start':
-        node.do_start(env, cmdline[1])
-    elif cmdline[0] == 'stop':
-        node.do_stop(env, cmdline[1])
-    elif cmdline[0] == 'reboot':
-        node.do_reboot(env, cmdline[1])
-    elif cmdline[0] == 'list_running':
-        node.do_list_running(env, True)
-    elif cmdline[0] == 'list_all':
-        node.do_list_all(env)
-    elif cmdline[0] == 'get_boot_device':
-        node.do_get_boot_device(env, cmdline[1])
-    elif cmdline[0] == 'set_boot_device':
-        node.do_set_boot_device(env, cmdline[2], cmdline[1])
-    elif cmdline[0] == 'get_node_macs':
-        node.do_get_macs(env, cmdline[1], True)
+    from . import factory
+    env = factory.get_environ(args)
+    run_command(env, cmdline)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,338 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import os
+import sys
+import json
+import time
+import socket
+import threading
+
+from six.moves import socketserver
+from six import StringIO
+
+from . import factory, proxy, runtime, trace, util, ravello, node, parallel, powerqueue
+from .runtime import LOG, CONF
+from .metrics import METRICS
+
+# The proxy daemon is a long running process that executes the virsh commands
+# that are forwarded to it by `python -mravstack.proxy`. Compared to running
+# each command in its own process, it saves the Python startup, the login to
+# the Ravello API, and for read-only commands also the fetch of the
+# application.
+#
+# The daemon also runs a background poller that refreshes the application on a
+# fixed cadence, and keeps a table with the power state, MAC addresses and
+# boot device of each node. Ironic lists the running nodes and gets the boot
+# devices of all nodes every sync interval; these are served from the table.
+# The changes that the daemon makes itself are applied to the table directly,
+# so that reads are consistent with our own writes.
+#
+# In write-behind mode, power commands are recorded in a power queue and
+# return right away. A worker in the daemon performs the queued actions.
+
+
+class ThreadLocalOutput(object):
+    """A replacement for `sys.stdout` that captures output per thread."""
+
+    def __init__(self, stream):
+        self._stream = stream
+        self._local = threading.local()
+
+    def start_capture(self):
+        self._local.buffer = StringIO()
+
+    def stop_capture(self):
+        output = self._local.buffer.getvalue()
+        self._local.buffer = None
+        return output
+
+    def write(self, data):
+        buf = getattr(self._local, 'buffer', None)
+        (self._stream if buf is None else buf).write(data)
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class NodeTable(object):
+    """A table with the state, MAC addresses and boot device of each node."""
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._nodes = []
+        self._refreshed = 0
+
+    def refresh(self, nodes, fetched):
+        """Replace the table with *nodes*, which were loaded at *fetched*.
+
+        Entries that we changed ourselves after *fetched* are kept, as the
+        change may not be visible yet in the loaded nodes.
+        """
+        with self._lock:
+            current = dict((node['name'], node) for node in self._nodes)
+            for ix, entry in enumerate(nodes):
+                old = current.get(entry['name'])
+                if old and old['changed'] > fetched:
+                    nodes[ix] = old
+            self._nodes = nodes
+            self._refreshed = fetched
+
+    def update(self, name, **values):
+        """Update the entry for node *name* after a change we made."""
+        with self._lock:
+            for entry in self._nodes:
+                if entry['name'] == name:
+                    entry.update(values, changed=time.time())
+
+    def is_fresh(self):
+        """Return whether the table is recent enough to be used."""
+        return time.time() - self._refreshed < self.max_age
+
+    def get(self, name):
+        """Return the entry for node *name*, or ``None``."""
+        with self._lock:
+            for entry in self._nodes:
+                if entry['name'] == name:
+                    return dict(entry)
+
+    def list_nodes(self):
+        """Return all entries, in the order of :func:`factory.get_nodes`."""
+        with self._lock:
+            return [dict(entry) for entry in self._nodes]
+
+
+def get_table_entries(env, app):
+    """Return the node table entries for *app*."""
+    journal = node.get_boot_journal(env, app)
+    entries = []
+    for vm in factory.get_nodes(app):
+        macs = [ravello.get_mac(conn) for conn in vm.get('networkConnections', [])]
+        entries.append({'name': vm['name'], 'state': vm['state'],
+                        'macs': [mac for mac in macs if mac],
+                        'bootdev': node.get_boot_device(vm, journal), 'changed': 0})
+    return entries
+
+
+class ProxyHandler(socketserver.StreamRequestHandler):
+    """Handle a single forwarded virsh command."""
+
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        output, error = self.server.run_command(request['command'],
+                                                request.get('context', ''),
+                                                request.get('trace'))
+        response = {'output': output, 'error': error}
+        self.wfile.write(json.dumps(response).encode('utf-8'))
+
+
+class ProxyServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """The proxy daemon."""
+
+    daemon_threads = True
+
+    def __init__(self, sockname, env):
+        socketserver.UnixStreamServer.__init__(self, sockname, ProxyHandler)
+        self.env = env
+        self.max_age = env.config['proxy'].getfloat('snapshot_max_age')
+        self.poll_interval = env.config['proxy'].getfloat('poll_interval')
+        self.output = ThreadLocalOutput(sys.stdout)
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._snapshot_time = 0
+        # The table is not used if a few polls in a row failed.
+        self.node_table = NodeTable(3 * self.poll_interval)
+        self.power_queue = None
+        if env.config['proxy'].getboolean('write_behind'):
+            appname = env.config.require('ravello', 'application')
+            self.power_queue = powerqueue.PowerQueue(runtime.get_runtime_dir(), appname)
+        self._power_event = threading.Event()
+        self._power_running = set()
+        # Not self._lock, which is held while the snapshot is reloaded.
+        self._power_lock = threading.Lock()
+
+    def start_poller(self):
+        """Start the background poller, if enabled."""
+        if self.poll_interval <= 0:
+            return
+        thread = threading.Thread(target=self._poll_loop, name='poller')
+        thread.daemon = True
+        thread.start()
+
+    def _poll_loop(self):
+        trace.set_context('poller')
+        while True:
+            start_time = time.time()
+            try:
+                self.poll()
+            except Exception:
+                LOG.error('Could not refresh application:', exc_info=True)
+            time.sleep(max(0, start_time + self.poll_interval - time.time()))
+
+    def poll(self):
+        """Refresh the application snapshot and the node table."""
+        with trace.span('poll'):
+            fetched = time.time()
+            app = factory.get_ravello_application(self.env, max_age=0)
+            self.node_table.refresh(get_table_entries(self.env, app), fetched)
+        with self._lock:
+            if fetched > self._snapshot_time:
+                self._snapshot = app
+                self._snapshot_time = fetched
+
+    def start_power_worker(self):
+        """Start the worker for the power queue, if write-behind is enabled."""
+        if self.power_queue is None:
+            return
+        thread = threading.Thread(target=self._power_loop, name='power')
+        thread.daemon = True
+        thread.start()
+
+    def _power_loop(self):
+        trace.set_context('power')
+        pool = parallel.get_pool(self.env.client, CONF['ravello'].getint('max_parallel'))
+        while True:
+            self._power_event.clear()
+            timeout = 30
+            try:
+                pending = self.power_queue.get_pending()
+            except Exception:
+                LOG.error('Could not read power queue:', exc_info=True)
+                pending = {}
+            now = time.time()
+            for nodename, entry in sorted(pending.items()):
+                with self._power_lock:
+                    if nodename in self._power_running:
+                        continue
+                    elif entry['next_try'] > now:
+                        timeout = min(timeout, entry['next_try'] - now)
+                        continue
+                    self._power_running.add(nodename)
+                pool.submit(self.run_power_action, nodename, entry)
+            self._power_event.wait(timeout)
+
+    def run_power_action(self, nodename, entry):
+        """Perform the queued power action *entry* for *nodename*."""
+        action = entry['action']
+        try:
+            with trace.span('power', node=nodename, action=action):
+                env = self.new_environ([action, nodename])
+                getattr(node, 'do_' + action)(env, nodename)
+        except Exception as e:
+            retry = self.power_queue.fail(nodename, entry['id'], str(e))
+            LOG.error('Action `{}` for node `{}` failed{}: {!s}'
+                            .format(action, nodename, ', retrying' if retry else '', e))
+            METRICS.increment('power_actions_failed')
+        else:
+            self.power_queue.complete(nodename, entry['id'])
+            LOG.info('Action `{}` for node `{}` completed.'.format(action, nodename))
+        finally:
+            self.invalidate_snapshot()
+            with self._power_lock:
+                self._power_running.discard(nodename)
+            # The action may have been replaced while it was running.
+            self._power_event.set()
+            runtime.save_metrics()
+
+    def get_snapshot(self):
+        """Return a recent snapshot of the application."""
+        with self._lock:
+            if time.time() - self._snapshot_time > self.max_age:
+                self._snapshot = factory.get_ravello_application(self.env, self.max_age)
+                self._snapshot_time = time.time()
+            return self._snapshot
+
+    def invalidate_snapshot(self):
+        """Invalidate the application snapshot."""
+        with self._lock:
+            self._snapshot_time = 0
+
+    def new_environ(self, cmdline):
+        """Return a new environment for running *cmdline*."""
+        env = factory.get_environ(self.env.args)
+        env.client = self.env.client
+        if self.poll_interval > 0:
+            env.node_table = self.node_table
+        env.power_queue = self.power_queue
+        if cmdline[0] in proxy.readonly_commands:
+            env.lazy_attr('application', self.get_snapshot)
+            env.shared_snapshot = True
+        return env
+
+    def run_command(self, command, context, trace_id=None):
+        """Run a virsh command and return a ``(output, error)`` tuple.
+
+        The spans for the command are added to trace *trace_id*, which is the
+        trace of the forwarding proxy process.
+        """
+        start_time = time.time()
+        self.output.start_capture()
+        trace.set_context(context)
+        try:
+            with trace.span('proxyd', trace_id):
+                cmdline = proxy.parse_virsh_command_line(command)
+                LOG.info('[{}] Parsed command: {}'.format(context, ' '.join(cmdline)))
+                trace.annotate(command=' '.join(cmdline))
+                try:
+                    env = self.new_environ(cmdline)
+                    if self.power_queue is not None and cmdline[0] in proxy.power_commands:
+                        node.queue_power_action(env, cmdline[1], cmdline[0])
+                        self._power_event.set()
+                    else:
+                        proxy.run_command(env, cmdline)
+                finally:
+                    if cmdline[0] not in proxy.readonly_commands:
+                        self.invalidate_snapshot()
+        except Exception as e:
+            LOG.error('[{}] Uncaught exception:'.format(context), exc_info=True)
+            error = str(e)
+        else:
+            error = None
+        output = self.output.stop_capture()
+        LOG.debug('[{}] Command completed in {:.2f} seconds.'
+                        .format(context, time.time() - start_time))
+        runtime.save_metrics()
+        return output, error
+
+
+def do_serve(env):
+    """The `ravstack proxyd` command."""
+    args = {'--cached': True}
+    CONF.update_from_args(args)
+    env.args.update(args)
+    sockname = proxy.get_socket_name()
+    if sockname is None:
+        raise RuntimeError('No runtime directory available.')
+    # Remove a stale socket left behind by a previous instance, but refuse to
+    # start if another instance is still listening.
+    if util.try_stat(sockname):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sockname)
+        except socket.error:
+            util.try_unlink(sockname)
+        else:
+            raise RuntimeError('Proxy daemon already running at `{}`.'.format(sockname))
+        finally:
+            sock.close()
+    env.client  # login now so that problems are reported at startup
+    server = ProxyServer(sockname, env)
+    os.chmod(sockname, 0o600)
+    server.start_poller()
+    server.start_power_worker()
+    sys.stdout = server.output
+    LOG.info('Proxy daemon listening on `{}`.'.format(sockname))
+    try:
+        server.serve_forever()
+    finally:
+        sys.stdout = server.output._stream
+        server.server_close()
+        util.try_unlink(sockname)
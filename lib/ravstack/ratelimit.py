@@ -0,0 +1,90 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import re
+import json
+import time
+import logging
+
+from . import util, trace
+from .metrics import METRICS
+
+LOG = logging.getLogger(__name__)
+
+# The rate limiter is a token bucket that is shared by all ravstack processes
+# of the same user, through a file in the runtime directory. Every API request
+# takes a token. Tokens are added at a sustained rate, up to a maximum (the
+# burst size).
+#
+# The budget is per user, not per host. Sharing it between users would need a
+# file that every user can write to, and the runtime directory is private to
+# each user. In a normal installation all API traffic comes from the "stack"
+# user: the Ironic proxy, the proxy daemon and the ravstack commands. Other
+# users each get a budget of their own, so `rate_limit` should leave room for
+# them.
+#
+# Requests have a priority. Lower priority requests must leave a reserve of
+# tokens in the bucket, so that when the bucket is nearly empty, power actions
+# go ahead of read-only traffic like listing the nodes.
+
+_re_power_action = re.compile('/applications/[0-9]+(/vms/[0-9]+/(start|stop|poweroff|restart)'
+                              '|/publishUpdates)$')
+
+
+def get_priority(method, url):
+    """Return the priority of a request: "high", "normal" or "low"."""
+    if method == 'POST' and _re_power_action.match(url):
+        return 'high'
+    elif method == 'GET':
+        return 'low'
+    return 'normal'
+
+
+class RateLimiter(object):
+    """A token bucket with a sustained *rate* in requests per second, and a
+    maximum of *burst* tokens. Low priority requests leave *reserve* tokens,
+    and normal priority requests half that."""
+
+    def __init__(self, fname, rate, burst, reserve):
+        self.fname = fname
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._floors = {'high': 0, 'normal': reserve / 2.0, 'low': reserve}
+
+    def _take(self, priority):
+        """Try to take a token. Return 0 on success, or the time to wait
+        before trying again."""
+        with util.lock_file(self.fname + '.lock'):
+            now = time.time()
+            state = util.read_json_file(self.fname, {})
+            elapsed = max(0, now - state.get('time', now))
+            tokens = min(self.burst, state.get('tokens', self.burst) + elapsed * self.rate)
+            floor = min(self._floors[priority], self.burst - 1)
+            if tokens - 1 >= floor:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (floor + 1 - tokens) / self.rate
+            util.write_file_atomic(self.fname, json.dumps({'tokens': tokens, 'time': now}))
+        return wait
+
+    def acquire(self, priority='normal'):
+        """Take a token, waiting until one is available."""
+        wait = self._take(priority)
+        if not wait:
+            return
+        METRICS.increment('requests_throttled')
+        start_time = time.time()
+        with trace.span('throttle', priority=priority):
+            while wait:
+                time.sleep(wait)
+                wait = self._take(priority)
+        LOG.debug('Throttled {} priority request for {:.2f} seconds.'
+                        .format(priority, time.time() - start_time))
@@ -8,12 +8,23 @@
 
 from __future__ import absolute_import, print_function
 
+import re
+import copy
+import hashlib
 import time
+import email.utils
 import logging
 import random
+import threading
 
-from requests import Session, HTTPError
-from requests.adapters import HTTPAdapter
+from requests import Session, HTTPError, RequestException, ConnectionError, ConnectTimeout, Timeout
+from requests.adapters import HTTPAdapter, DEFAULT_POOLSIZE
+from requests.utils import dict_from_cookiejar, cookiejar_from_dict
+from requests.packages.urllib3.exceptions import ConnectTimeoutError
+
+from . import trace
+from .ratelimit import get_priority
+from .metrics import METRICS, url_template
 
 LOG = logging.getLogger(__name__)
 
@@ -25,6 +36,9 @@ magic_svm_cpuids = [
     {"index": "80000001", "value": "00000000000000000000001520100800"}, ]
 
 
+_re_app_url = re.compile('/applications/([0-9]+)')
+
+
 class RavelloClient(Session):
     """
     A super minimal interface to the Ravello API, based on ``requests.Session``.
@@ -35,14 +49,35 @@ class RavelloClient(Session):
     default_retries = 3
     default_redirects = 3
 
-    def __init__(self):
+    def __init__(self, url=None):
         super(RavelloClient, self).__init__()
+        if url is not None:
+            self.default_url = url
         self.headers['Accept'] = 'application/json'
         self.max_redirects = self.default_redirects
-        adapter = HTTPAdapter(max_retries=self.default_retries)
+        # Connection failures are retried by request(), within the deadline of
+        # the current operation, and not by the transport.
+        adapter = HTTPAdapter(max_retries=0)
         self.mount('http://', adapter)
         self.mount('https://', adapter)
+        self.pool_size = DEFAULT_POOLSIZE
         self.user_info = None
+        self.session_cache = None
+        self.snapshot_cache = None
+        self.request_cache = None
+        self.rate_limiter = None
+        self.breaker = None
+        self._credentials = None
+
+    def set_pool_size(self, size):
+        """Make sure the connection pool can hold at least *size*
+        connections per host, for use by that many threads."""
+        if size <= self.pool_size:
+            return
+        self.pool_size = size
+        adapter = HTTPAdapter(max_retries=0, pool_maxsize=size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
 
     def _raise_for_status(self, r):
         """Raise an exception if *resp* is an error response."""
@@ -63,25 +98,156 @@ class RavelloClient(Session):
             message += ' ({}: {})'.format(err_code, err_message)
         raise HTTPError(message, response=r)
 
-    def login(self, username, password):
-        """Login to the API."""
-        resp = self.request('POST', '/login', auth=(username, password))
+    def _session_key(self):
+        # Include a hash of the password, so that a session is not reused
+        # after the password was changed, or for a wrong password.
+        digest = hashlib.sha256('{}:{}'.format(*self._credentials).encode('utf-8')).hexdigest()
+        return '{} {} {}'.format(self.default_url, self._credentials[0], digest)
+
+    def _login(self):
+        """Login to the API and store the session in the session cache, if
+        there is one. The cache must be locked."""
+        with trace.span('login'):
+            resp = self.request('POST', '/login', auth=self._credentials)
         self._raise_for_status(resp)
         self.user_info = resp.json()
         self.cookies = resp.cookies
+        if self.session_cache is not None:
+            session = {'cookies': dict_from_cookiejar(self.cookies),
+                       'user_info': self.user_info}
+            self.session_cache.save(self._session_key(), session)
+
+    def _restore(self, session):
+        """Restore a session from the session cache."""
+        self.user_info = session['user_info']
+        self.cookies = cookiejar_from_dict(session['cookies'])
+
+    def login(self, username, password):
+        """Login to the API.
+
+        If there is a session cache, then a cached session is reused if there
+        is one. The session is not validated; if it turns out to be expired,
+        the next request will log in again.
+        """
+        self._credentials = (username, password)
+        if self.session_cache is None:
+            self._login()
+            return
+        with self.session_cache.lock():
+            session = self.session_cache.load(self._session_key())
+            if session:
+                LOG.debug('Reusing cached session.')
+                self._restore(session)
+            else:
+                self._login()
+
+    def relogin(self, cookies):
+        """Login again after the session with *cookies* expired."""
+        if self.session_cache is None:
+            self._login()
+            return
+        # Another process may have already logged in while we were waiting for
+        # the lock. In that case its session is reused.
+        with self.session_cache.lock():
+            session = self.session_cache.load(self._session_key())
+            if session and session['cookies'] != cookies:
+                LOG.debug('Reusing session from other process.')
+                self._restore(session)
+            else:
+                self._login()
 
     def logout(self):
         self.request('POST', '/logout')
         self.cookies.clear()
+        if self.session_cache is not None:
+            with self.session_cache.lock():
+                self.session_cache.remove(self._session_key())
+
+    def _request(self, method, url, **kwargs):
+        """Perform a request and record it in the metrics and the trace."""
+        relurl = url[len(self.default_url):] if url.startswith(self.default_url) else url
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(get_priority(method, relurl))
+        if self.breaker is not None:
+            self.breaker.check()
+        with trace.span('{} {}'.format(method, url_template(relurl))) as sp:
+            start_time = time.time()
+            try:
+                r = super(RavelloClient, self).request(method, url, **kwargs)
+            except RequestException as e:
+                METRICS.record_request(method, relurl, type(e).__name__,
+                                       time.time() - start_time, 0)
+                if self.breaker is not None and isinstance(e, (ConnectionError, Timeout)):
+                    self.breaker.record_failure(e)
+                raise
+            if self.breaker is not None:
+                self.breaker.record_success()
+            METRICS.record_request(method, relurl, r.status_code,
+                                   time.time() - start_time, len(r.content))
+            sp.set(status=r.status_code, size=len(r.content))
+        return r
+
+    def _send(self, method, url, **kwargs):
+        """Perform a request. A failure to connect is retried up to
+        `default_retries` times, but not past the deadline of the current
+        operation. The timeout of each attempt is clamped to the deadline."""
+        tries = 0
+        while True:
+            timeout = kwargs.get('timeout') or clamp_timeout(self.default_timeout)
+            try:
+                return self._request(method, url, **dict(kwargs, timeout=timeout))
+            except ConnectionError as e:
+                tries += 1
+                if not is_connect_error(e) or tries > self.default_retries \
+                            or time_left(1) <= 0:
+                    raise
+                LOG.debug('Retrying connection ({}/{}): {!s}'
+                                .format(tries, self.default_retries, e))
 
     def request(self, method, url, **kwargs):
         if url.startswith('/'):
             url = self.default_url + url
-        if 'timeout' not in kwargs:
-            kwargs['timeout'] = self.default_timeout
-        return super(RavelloClient, self).request(method, url, **kwargs)
+        cookies = dict_from_cookiejar(self.cookies)
+        r = self._send(method, url, **kwargs)
+        if r.status_code == 401 and self._credentials and 'auth' not in kwargs:
+            LOG.debug('Session expired, logging in again.')
+            self.relogin(cookies)
+            r = self._send(method, url, **kwargs)
+        # Any call other than GET to an application or one of its VMs may
+        # change it. Invalidate the cached snapshot, also if the call failed
+        # because we can't be sure it had no effect.
+        match = _re_app_url.match(url[len(self.default_url):])
+        if match and method != 'GET' and self.snapshot_cache is not None:
+            LOG.debug('Invalidating cached application {}.'.format(match.group(1)))
+            self.snapshot_cache.invalidate(match.group(1))
+        return r
+
+    def _shared_get(self, url):
+        """Perform a GET request on *url*, or reuse the result of an identical
+        request that another process just made."""
+        wanted = time.time()
+        # Results from before the last change to the application are stale.
+        match = _re_app_url.match(url)
+        not_before = self.snapshot_cache.get_invalidated(match.group(1)) \
+                        if match and self.snapshot_cache is not None else 0
+        with self.request_cache.lock(url):
+            data = self.request_cache.load(url, wanted, not_before)
+            if data is not None:
+                LOG.debug('Reusing result of concurrent request `GET {}`.'.format(url))
+                METRICS.increment('requests_deduplicated')
+                return data['result']
+            started = time.time()
+            result = self._call('GET', url)
+            self.request_cache.save(url, result, started)
+        return result
 
     def call(self, method, url, body=None, **kwargs):
+        if method == 'GET' and body is None and not kwargs and url.startswith('/') \
+                    and self.request_cache is not None:
+            return self._shared_get(url)
+        return self._call(method, url, body, **kwargs)
+
+    def _call(self, method, url, body=None, **kwargs):
         if body is not None:
             kwargs['json'] = body
         r = self.request(method, url, **kwargs)
@@ -91,50 +257,274 @@ class RavelloClient(Session):
         return r.json()
 
 
+def diff(old, new, path=''):
+    """Yield the paths at which the JSON documents *old* and *new* differ."""
+    if isinstance(old, dict) and isinstance(new, dict):
+        for key in sorted(set(old) | set(new)):
+            subpath = '{}.{}'.format(path, key) if path else key
+            if key not in old or key not in new:
+                yield subpath
+                continue
+            for changed in diff(old[key], new[key], subpath):
+                yield changed
+    elif isinstance(old, list) and isinstance(new, list) and len(old) == len(new):
+        for ix, (oldval, newval) in enumerate(zip(old, new)):
+            for changed in diff(oldval, newval, '{}[{}]'.format(path, ix)):
+                yield changed
+    elif old != new:
+        yield path
+
+
+class ApplicationUpdate(object):
+    """Track changes to the design of an application and push them to the API.
+
+    Changed VMs are pushed one by one with the per-VM update call, which is
+    much smaller than an update of the entire application, and less likely to
+    conflict with concurrent updates. A full update is done if VMs were added,
+    or if the per-VM call is not available. Changes still need to be published
+    by the caller.
+
+    The design VMs are compared against a copy taken when the update was
+    created, so the update must be created before the application is changed.
+    VMs that end up being the same are not pushed.
+    """
+
+    def __init__(self, client, app):
+        self.client = client
+        self.app = app
+        self._original = {vm['id']: copy.deepcopy(vm)
+                          for vm in get_vms(app, 'design') if 'id' in vm}
+        self._changed = []
+        self._full = False
+
+    def touch(self, vm):
+        """Mark the design VM *vm* as changed."""
+        if 'id' not in vm:
+            self._full = True
+        elif not any(changed is vm for changed in self._changed):
+            self._changed.append(vm)
+
+    def add_vm(self, vm):
+        """Add a new VM to the design."""
+        self.app['design']['vms'].append(vm)
+        self._full = True
+
+    def _is_changed(self, vm):
+        return next(diff(self._original.get(vm['id']), vm), None) is not None
+
+    def _get_changed(self):
+        """Return the touched VMs that actually changed."""
+        changed = []
+        for vm in self._changed:
+            paths = list(diff(self._original.get(vm['id']), vm))
+            if paths:
+                LOG.debug('VM `{}` changed: {}.'.format(vm['name'], ', '.join(paths)))
+                changed.append(vm)
+            else:
+                LOG.debug('VM `{}` is unchanged.'.format(vm['name']))
+        return changed
+
+    def has_changes(self):
+        """Return whether there are changes to push."""
+        return self._full or any(self._is_changed(vm) for vm in self._changed)
+
+    def push(self):
+        """Push the changes and return the updated application."""
+        app = self.app
+        if not self._full:
+            vms = get_vms(app, 'design')
+            for vm in self._get_changed():
+                url = '/applications/{}/vms/{}'.format(app['id'], vm['id'])
+                try:
+                    updated = self.client.call('PUT', url, vm)
+                except HTTPError as e:
+                    if e.response.status_code not in (404, 405):
+                        raise
+                    LOG.debug('Per-VM update not available, updating application.')
+                    self._full = True
+                    break
+                if updated:
+                    vms[:] = [updated if v is vm else v for v in vms]
+        if self._full and app.get('partial'):
+            # A partial application only has some of the VMs. Merge its design
+            # VMs into the full application, or the others would be deleted.
+            LOG.debug('Loading full application for update.')
+            partial = dict((vm['id'], vm) for vm in get_vms(app, 'design') if 'id' in vm)
+            app = self.client.call('GET', '/applications/{id}'.format(**app))
+            vms = app['design']['vms']
+            vms[:] = [partial.get(vm.get('id'), vm) for vm in vms]
+            vms += [vm for vm in get_vms(self.app, 'design') if 'id' not in vm]
+        if self._full:
+            app = self.client.call('PUT', '/applications/{id}'.format(**app), app)
+        self.app = app
+        self._original = {vm['id']: copy.deepcopy(vm)
+                          for vm in get_vms(app, 'design') if 'id' in vm}
+        self._changed = []
+        self._full = False
+        return app
+
+
 class Retry(RuntimeError):
     """Exception used to indicate to retry_operation() that it needs to
     retry."""
 
 
-_default_retries = {409: 10}
+_default_retries = {409: 10, 429: 5}
+
+_local = threading.local()
+
+
+def get_deadline():
+    """Return the deadline of the current operation, or ``None``."""
+    return getattr(_local, 'deadline', None)
 
-def retry_operation(func, timeout=60, retries=None):
-    """Retry an operation on various 4xx errors."""
-    end_time = time.time() + timeout
-    tries = {}
-    if retries is None:
-        retries = _default_retries
+
+def set_deadline(deadline):
+    """Set the deadline of the current operation in this thread."""
+    _local.deadline = deadline
+
+
+def time_left(default):
+    """Return the time left until the deadline of the current operation, or
+    *default* if there is no deadline."""
+    deadline = get_deadline()
+    return default if deadline is None else max(0, deadline - time.time())
+
+
+def clamp_timeout(timeout):
+    """Clamp a ``(connect, read)`` request timeout to the deadline of the
+    current operation."""
+    deadline = get_deadline()
+    if deadline is None:
+        return timeout
+    left = deadline - time.time()
+    if left <= 0:
+        raise RuntimeError('Deadline exceeded.')
+    return tuple(min(t, left) for t in timeout)
+
+
+def is_connect_error(error):
+    """Return whether the :class:`ConnectionError` *error* is a failure to
+    connect. The request was then not sent, so it is safe to retry."""
+    if isinstance(error, ConnectTimeout):
+        return True
+    reason = getattr(error.args[0] if error.args else None, 'reason', None)
+    return isinstance(reason, ConnectTimeoutError)  # includes NewConnectionError
+
+
+def get_retry_after(response):
+    """Return the delay requested by a Retry-After header in *response*, in
+    seconds, or ``None``."""
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return
+    if value.strip().isdigit():
+        return int(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return
+    return max(0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class RetryPolicy(object):
+    """A policy for retrying an operation.
+
+    The delays between attempts grow exponentially with "decorrelated
+    jitter": each delay is chosen at random between `base_delay` and three
+    times the previous delay, up to `max_delay`. A longer delay requested by
+    the server with a Retry-After header is honoured. The number of retries
+    is limited per HTTP status by *retries*, and the total time by *timeout*.
+    """
+
+    base_delay = 0.5
+    max_delay = 10
+
+    def __init__(self, timeout=60, retries=None):
+        self.deadline = time.time() + timeout
+        self.retries = _default_retries if retries is None else retries
+        self.tries = {}
+        self._delay = self.base_delay
+
+    def time_left(self):
+        """Return the time left until the deadline."""
+        return self.deadline - time.time()
+
+    def allow_retry(self, status):
+        """Count a retry for HTTP *status*, and return whether it is allowed."""
+        if status not in self.retries:
+            return False
+        self.tries[status] = self.tries.get(status, 0) + 1
+        return self.tries[status] < self.retries[status]
+
+    def next_delay(self, response=None):
+        """Return the delay before the next attempt."""
+        self._delay = min(self.max_delay, random.uniform(self.base_delay, 3 * self._delay))
+        delay = self._delay
+        retry_after = get_retry_after(response)
+        if retry_after is not None:
+            LOG.debug('Server requested retry after {:.2f} seconds.'.format(retry_after))
+            delay = max(delay, retry_after)
+        return max(0, min(delay, self.time_left()))
+
+
+def retry_operation(func, timeout=60, retries=None, policy=None):
+    """Retry an operation on various 4xx errors.
+
+    The operation is retried according to *policy*, which by default is a
+    :class:`RetryPolicy` with *timeout* and *retries*. Its deadline also
+    applies to the API requests made by the operation, and to any nested
+    retried operations.
+    """
+    if policy is None:
+        policy = RetryPolicy(timeout, retries)
+    outer = get_deadline()
+    if outer is not None:
+        policy.deadline = min(policy.deadline, outer)
+    _local.deadline = policy.deadline
+    try:
+        return _retry_operation(func, policy)
+    finally:
+        _local.deadline = outer
+
+
+def _retry_operation(func, policy):
     count = 0
-    delay = min(10, max(2, timeout/100))
     start_time = time.time()
-    while end_time > time.time():
-        count += 1
-        try:
-            ret = func()
-        except HTTPError as e:
-            status = e.response.status_code
-            if status not in retries:
-                raise
-            LOG.debug('Retry: {!s}'.format(e))
-            tries.setdefault(status, 0)
-            tries[status] += 1
-            if not 0 < tries[status] < retries[status]:
-                LOG.error('Max retries reached for status {} ({})'
-                                .format(status, retries[status]))
-                raise
-            LOG.warning('Retry number {} out of {} for status {}.'
-                            .format(tries[status], retries[status], status))
-        except Retry as e:
-            LOG.warning('Retry requested: {}.'.format(e))
-        else:
-            time_spent = time.time() - start_time
-            LOG.debug('Operation succeeded after {} attempt{} ({:.2f} seconds).'
-                            .format(count, 's' if count > 1 else '', time_spent))
-            return ret
-        loop_delay = delay + random.random()
-        LOG.debug('Sleeping for {:.2f} seconds.'.format(loop_delay))
-        time.sleep(loop_delay)
+    with trace.span('retry', operation=func.__name__):
+        while policy.time_left() > 0:
+            count += 1
+            response = None
+            try:
+                with trace.span('attempt', attempt=count):
+                    ret = func()
+            except HTTPError as e:
+                status = e.response.status_code
+                if status not in policy.retries:
+                    raise
+                LOG.debug('Retry: {!s}'.format(e))
+                if not policy.allow_retry(status):
+                    LOG.error('Max retries reached for status {} ({})'
+                                    .format(status, policy.retries[status]))
+                    METRICS.increment('retries_exhausted')
+                    raise
+                LOG.warning('Retry number {} out of {} for status {}.'
+                                .format(policy.tries[status], policy.retries[status], status))
+                METRICS.record_retry(status)
+                response = e.response
+            except Retry as e:
+                LOG.warning('Retry requested: {}.'.format(e))
+                METRICS.record_retry('state')
+            else:
+                time_spent = time.time() - start_time
+                LOG.debug('Operation succeeded after {} attempt{} ({:.2f} seconds).'
+                                .format(count, 's' if count > 1 else '', time_spent))
+                return ret
+            loop_delay = policy.next_delay(response)
+            LOG.debug('Sleeping for {:.2f} seconds.'.format(loop_delay))
+            with trace.span('sleep'):
+                time.sleep(loop_delay)
     time_spent = time.time() - start_time
+    METRICS.increment('retries_exhausted')
     raise RuntimeError('Timeout retrying function `{.__name__}` ({:.2f} seconds).'
                         .format(func, time_spent))
 
@@ -8,10 +8,12 @@
 
 from __future__ import absolute_import, print_function
 
+import os
 import sys
+import time
 import logging
 
-from . import config, defaults, util
+from . import config, defaults, util, metrics, trace
 
 prog_name = __name__.split('.')[0]
 
@@ -47,6 +49,7 @@ def setup_logging(context=None):
     global log_context
     if context is not None:
         log_context = context
+    trace.default_context = log_context
     template = log_ctx_template.format(log_context) if log_context else log_template
     # Log to stderr?
     if LOG_STDERR:
@@ -72,19 +75,86 @@ def setup_logging(context=None):
     logger.setLevel(logging.DEBUG if DEBUG else logging.ERROR)
 
 
+_runtime_dir = None
+
+def get_runtime_dir():
+    """Return the per-user runtime directory, or ``None`` if not available.
+
+    The runtime directory is a private subdirectory of the global runtime
+    directory, named after the current user. The global runtime directory
+    must not be writable by others. The subdirectories are created by
+    `ravstack setup` for the users in `runtime_users`.
+    """
+    global _runtime_dir
+    if _runtime_dir is not None:
+        return _runtime_dir
+    st = util.try_stat(defaults.runtime_dir)
+    if st is None:
+        LOG.debug('runtime directory `{}` does not exist.'.format(defaults.runtime_dir))
+        return
+    elif st.st_mode & 0o022:
+        LOG.error('runtime directory `{}` is writable by others; run `ravstack setup`.'
+                        .format(defaults.runtime_dir))
+        return
+    dirname = os.path.join(defaults.runtime_dir, util.get_user())
+    try:
+        util.create_directory(dirname, 0o700)
+    except OSError as e:
+        LOG.debug('cannot create runtime directory `{}`: {!s}'.format(dirname, e))
+        return
+    st = os.stat(dirname)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        LOG.error('runtime directory `{}` has insecure ownership or permissions.'
+                        .format(dirname))
+        return
+    _runtime_dir = dirname
+    return _runtime_dir
+
+
+def get_stats_file():
+    """Return the name of the stats file, or ``None``."""
+    rtdir = get_runtime_dir()
+    if rtdir:
+        return os.path.join(rtdir, 'stats.json')
+
+
+def save_metrics():
+    """Merge the metrics collected by this process into the stats file."""
+    fname = get_stats_file()
+    if fname is None:
+        return
+    promfile = CONF.get(prog_name, 'prometheus_file', fallback='<None>')
+    try:
+        metrics.METRICS.save(fname, None if promfile == '<None>' else promfile)
+    except (IOError, OSError) as e:
+        LOG.error('could not save metrics: {!s}'.format(e))
+
+
+def setup_tracing():
+    """Set up tracing."""
+    fname = CONF.get(prog_name, 'trace_file', fallback='<None>')
+    trace.trace_file = None if fname == '<None>' else os.path.expanduser(fname)
+
+
 # Run a main function
 
 def run_main(func):
     """Run a main function."""
 
+    start_time = time.time()
     setup_config()
     setup_logging()
+    setup_tracing()
 
     # Run the provided main function.
     try:
-        func()
+        with trace.span('main', start=start_time):
+            trace.record('config', start_time, time.time())
+            func()
     except Exception as e:
         LOG.error('Uncaught exception:', exc_info=True)
         if DEBUG:
             raise
         print('Error: {!s}'.format(e))
+    finally:
+        save_metrics()
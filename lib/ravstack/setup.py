@@ -9,6 +9,7 @@
 from __future__ import absolute_import, print_function
 
 import os
+import pwd
 import json
 import binascii
 
@@ -16,6 +17,22 @@ from . import util, defaults
 from .runtime import CONF
 
 
+def create_user_runtime_dir(rtdir, user):
+    """Create the private runtime directory for *user* under *rtdir*."""
+    try:
+        pw = pwd.getpwnam(user)
+    except KeyError:
+        print('Skipping runtime directory for unknown user `{}`.'.format(user))
+        return
+    dirname = os.path.join(rtdir, user)
+    if util.try_stat(dirname) is None:
+        util.create_directory(dirname, 0o700)
+        print('Created runtime directory `{}`.'.format(dirname))
+    if os.getuid() == 0:
+        os.chown(dirname, pw.pw_uid, pw.pw_gid)
+    os.chmod(dirname, 0o700)
+
+
 def do_setup(env):
     """The 'ravstack setup` command."""
 
@@ -43,13 +60,22 @@ def do_setup(env):
         util.create_file(logname)
         print('Created log file `{}`.'.format(logname))
 
-    # Create runtime directory and per-instance unique password.
+    # Create runtime directory and per-instance unique password. The runtime
+    # directory contains the password file, so only its owner may write to
+    # it. Each user in `runtime_users` gets a private subdirectory for its
+    # sessions, caches and sockets. This also fixes up existing directories.
     pwname = defaults.password_file
     rtdir, _ = os.path.split(pwname)
     st = util.try_stat(rtdir)
     if st is None:
         util.create_directory(rtdir)
         print('Created runtime directory `{}`.'.format(rtdir))
+    elif st.st_mode & 0o022:
+        os.chmod(rtdir, 0o755)
+        print('Removed write permission for others from `{}`.'.format(rtdir))
+    for user in CONF[defaults.prog_name]['runtime_users'].split(','):
+        if user.strip():
+            create_user_runtime_dir(rtdir, user.strip())
     instance = util.get_cloudinit_instance() or 'unset'
     if instance:
         st = util.try_stat(pwname)
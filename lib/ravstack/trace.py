@@ -0,0 +1,192 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import os
+import json
+import time
+import random
+import logging
+import threading
+import contextlib
+
+LOG = logging.getLogger(__name__)
+
+# A trace is a tree of timed spans for a single command. The root span is
+# created by `runtime.run_main()`, or by the proxy daemon for each command it
+# runs. When the root span finishes, a timing breakdown is logged, and if a
+# trace file is configured all spans are appended to it as JSON lines.
+#
+# This module is used by the proxy, so it must only use the stdlib.
+
+trace_file = None
+default_context = ''
+
+_local = threading.local()
+
+
+def new_id():
+    """Return a new random trace or span ID."""
+    return '{:016x}'.format(random.getrandbits(64))
+
+
+def set_context(context):
+    """Set the context (e.g. the proxy connection) for the current thread."""
+    _local.context = context
+
+
+def get_context():
+    """Return the context for the current thread."""
+    return getattr(_local, 'context', None) or default_context
+
+
+class Span(object):
+    """A timed operation."""
+
+    def __init__(self, name, trace_id, parent_id, attrs):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id()
+        self.parent_id = parent_id
+        self.context = get_context()
+        self.attrs = attrs
+        self.start = time.time()
+        self.duration = None
+
+    def set(self, **attrs):
+        """Set attributes on this span."""
+        self.attrs.update(attrs)
+
+    def to_dict(self):
+        span = {'trace': self.trace_id, 'span': self.span_id, 'parent': self.parent_id,
+                'name': self.name, 'start': self.start, 'duration': self.duration,
+                'pid': os.getpid()}
+        if self.context:
+            span['context'] = self.context
+        if self.attrs:
+            span['attrs'] = self.attrs
+        return span
+
+
+def current():
+    """Return the current span, or ``None``."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+def annotate(**attrs):
+    """Set attributes on the current span, if any."""
+    sp = current()
+    if sp is not None:
+        sp.set(**attrs)
+
+
+@contextlib.contextmanager
+def span(name, trace_id=None, start=None, **attrs):
+    """Return a context manager that times a new span.
+
+    If there is no current span, the new span becomes the root of a new trace,
+    with ID *trace_id* if specified.
+    """
+    stack = _local.__dict__.setdefault('stack', [])
+    parent = stack[-1] if stack else None
+    if parent is None:
+        _local.finished = []
+        sp = Span(name, trace_id or new_id(), None, attrs)
+    else:
+        sp = Span(name, parent.trace_id, parent.span_id, attrs)
+    if start is not None:
+        sp.start = start
+    stack.append(sp)
+    try:
+        yield sp
+    except Exception as e:
+        sp.set(error=type(e).__name__)
+        raise
+    finally:
+        sp.duration = time.time() - sp.start
+        stack.pop()
+        _local.finished.append(sp)
+        if parent is None:
+            finished, _local.finished = _local.finished, []
+            finish_trace(sp, finished)
+
+
+def capture():
+    """Return the tracing state of the current thread, for use with
+    :func:`attach` in another thread."""
+    return current(), getattr(_local, 'finished', None), get_context()
+
+
+@contextlib.contextmanager
+def attach(state):
+    """Return a context manager that continues the trace captured with
+    :func:`capture` in the current thread. Spans created in the block are
+    children of the span that was current, and are part of its trace."""
+    parent, finished, context = state
+    set_context(context)
+    if parent is not None:
+        _local.stack = [parent]
+        _local.finished = finished
+    try:
+        yield
+    finally:
+        _local.stack = []
+        _local.finished = []
+        set_context(None)
+
+
+def record(name, start, end, **attrs):
+    """Add a span for an operation that has already completed. This is only
+    done if there is a current span."""
+    parent = current()
+    if parent is None:
+        return
+    sp = Span(name, parent.trace_id, parent.span_id, attrs)
+    sp.start = start
+    sp.duration = end - start
+    _local.finished.append(sp)
+
+
+def format_breakdown(root, spans):
+    """Return a one line timing breakdown for a trace."""
+    totals = {}
+    for sp in spans:
+        if sp is root:
+            continue
+        count, duration = totals.get(sp.name, (0, 0.0))
+        totals[sp.name] = (count + 1, duration + sp.duration)
+    parts = ['{} {}x {:.2f}s'.format(name, count, duration)
+             for name, (count, duration) in sorted(totals.items(), key=lambda x: -x[1][1])]
+    command = root.attrs.get('command', root.name)
+    return 'Timing for `{}`: {:.2f}s total; {}.'.format(command, root.duration,
+                                                       ', '.join(parts) or 'no spans')
+
+
+def finish_trace(root, spans):
+    """Log and store a completed trace."""
+    if LOG.isEnabledFor(logging.INFO):
+        # The global context is already part of the log format.
+        context = root.context if root.context != default_context else None
+        prefix = '[{}] '.format(context) if context else ''
+        LOG.info(prefix + format_breakdown(root, spans))
+    if not trace_file:
+        return
+    spans.sort(key=lambda sp: sp.start)
+    lines = ''.join(json.dumps(sp.to_dict(), sort_keys=True) + '\n' for sp in spans)
+    # A single write to a file opened with O_APPEND, so that the traces of
+    # concurrent processes are not interleaved.
+    try:
+        fd = os.open(trace_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            os.write(fd, lines.encode('utf-8'))
+        finally:
+            os.close(fd)
+    except (IOError, OSError) as e:
+        LOG.error('could not write trace: {!s}'.format(e))
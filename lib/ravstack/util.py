@@ -11,6 +11,9 @@ from __future__ import absolute_import, print_function
 import os
 import pwd
 import errno
+import fcntl
+import tempfile
+import contextlib
 import socket
 import struct
 import subprocess
@@ -19,6 +22,8 @@ import locale
 import json
 import re
 
+from . import trace
+
 
 _memodata = {}
 
@@ -93,6 +98,15 @@ def create_directory(dirname, mode=0o755):
             raise
 
 
+def pid_exists(pid):
+    """Return whether a process with ID *pid* exists."""
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+
 def try_stat(fname):
     """Call `os.stat(fname)`. Return the stat result, or `None` if the file
     does not exist."""
@@ -124,6 +138,57 @@ def try_unlink(fname):
             raise
 
 
+@contextlib.contextmanager
+def lock_file(fname, shared=False, on_wait=None):
+    """Context manager that holds a lock on *fname* for the duration of the
+    block. The file is created if it doesn't exist. If *on_wait* is given, it
+    is called before waiting for a lock that is held by someone else."""
+    fd = os.open(fname, os.O_RDWR|os.O_CREAT, 0o600)
+    try:
+        mode = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+        if on_wait is not None:
+            try:
+                fcntl.flock(fd, mode|fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                on_wait()
+                fcntl.flock(fd, mode)
+        else:
+            fcntl.flock(fd, mode)
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def write_file_atomic(fname, contents, mode=0o600):
+    """Atomically replace the contents of file *fname*."""
+    dirname, _ = os.path.split(fname)
+    fd, tmpname = tempfile.mkstemp(dir=dirname or '.')
+    try:
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(contents)
+        os.chmod(tmpname, mode)
+        os.rename(tmpname, fname)
+    except Exception:
+        try_unlink(tmpname)
+        raise
+
+
+def read_json_file(fname, default=None):
+    """Read a JSON file. Return *default* if the file does not exist or is
+    corrupt."""
+    try:
+        with open(fname) as fin:
+            return json.loads(fin.read())
+    except IOError as e:
+        if e.errno != errno.ENOENT:
+            raise
+    except ValueError:
+        pass
+    return default
+
+
 def mask_dict(d, *names):
     """Mask certain values in a dict."""
     m = {}
@@ -141,6 +206,15 @@ def filter_dict(d, *keys):
     return f
 
 
+def unique(items):
+    """Yield the unique items from *items*, preserving their order."""
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            yield item
+
+
 _re_field = re.compile(r'\{[^}]*\}')
 
 def unique_name_seqno(template, names):
@@ -188,7 +262,8 @@ def run_ssh(addr, command, **kwargs):
     if isinstance(command, str):
         command = [command]
     cmdargs = ['ssh', '-T', '-o', 'StrictHostKeyChecking=no', addr] + command
-    output = subprocess.check_output(cmdargs, **kwargs)
+    with trace.span('ssh', host=addr):
+        output = subprocess.check_output(cmdargs, **kwargs)
     return output.decode(encoding)
 
 
@@ -197,7 +272,8 @@ def can_run_sudo(command='/bin/sh', user='root'):
     if isinstance(command, str):
         command = [command]
     cmdargs = ['sudo', '-n', '-u', user, '-l'] + command
-    ret = subprocess.call(cmdargs, stdout=subprocess.DEVNULL)
+    with trace.span('sudo', user=user, command=command[0]):
+        ret = subprocess.call(cmdargs, stdout=subprocess.DEVNULL)
     return ret == 0
 
 
@@ -209,7 +285,8 @@ def run_sudo(command, user='root', **kwargs):
     if isinstance(command, str):
         command = [command]
     cmdargs = ['sudo', '-u', user] + command
-    output = subprocess.check_output(cmdargs, **kwargs)
+    with trace.span('sudo', user=user, command=command[0]):
+        output = subprocess.check_output(cmdargs, **kwargs)
     return output.decode(encoding)
 
 
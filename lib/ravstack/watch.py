@@ -0,0 +1,131 @@
+#
+# This file is part of ravstack. Ravstack is free software available under
+# the terms of the MIT license. See the file "LICENSE" that was provided
+# together with this source file for the licensing terms.
+#
+# Copyright (c) 2015 the ravstack authors. See the file "AUTHORS" for a
+# complete list.
+
+from __future__ import absolute_import, print_function
+
+import time
+import random
+import logging
+
+from . import ravello, factory, trace
+
+LOG = logging.getLogger(__name__)
+
+# A VM watcher polls the state of a set of VMs until they are all in a desired
+# state. Polling is adaptive: it is fast right after an action, when a state
+# change is likely imminent, and backs off with jitter while the VMs stay in
+# a transient state like STARTING or STOPPING. Every state change resets the
+# delay, as there are often several changes in a row (STOPPING -> STOPPED).
+#
+# A watcher for a few VMs loads just those VMs, using the same VM level API
+# calls as the per-node commands.
+
+
+class VmWatcher(object):
+    """Watch the state of VMs *nodenames* in the application, or all VMs if
+    *nodenames* is not specified.
+
+    If *app* is specified, it is used as the initial state of the VMs, and
+    waiting starts with a delay rather than a poll.
+    """
+
+    min_delay = 1
+    max_delay = 10
+    backoff = 1.5
+
+    def __init__(self, env, nodenames=None, app=None):
+        self.env = env
+        self.nodenames = nodenames
+        self.app = None
+        self.polls = 0
+        self._states = {}
+        self._times = {}
+        if app is not None:
+            self._update(app)
+
+    def _fetch(self):
+        if self.nodenames is None:
+            return factory.get_ravello_application(self.env, max_age=0)
+        return factory.get_node_application(self.env, self.nodenames)
+
+    def poll(self):
+        """Load the current state of the VMs.
+
+        Return a list of ``(nodename, old_state, new_state)`` transitions
+        since the previous poll. The old state is ``None`` on the first poll.
+        """
+        self.polls += 1
+        return self._update(self._fetch())
+
+    def _update(self, app):
+        self.app = app
+        now = time.time()
+        transitions = []
+        for vm in ravello.get_vms(app):
+            name = vm['name']
+            if self.nodenames is not None and name not in self.nodenames:
+                continue
+            old, since = self._states.get(name, (None, now))
+            if vm['state'] == old:
+                continue
+            if old is not None:
+                times = self._times.setdefault(name, {})
+                times[old] = times.get(old, 0) + now - since
+            self._states[name] = (vm['state'], now)
+            transitions.append((name, old, vm['state']))
+        return transitions
+
+    def get_state(self, nodename):
+        """Return the last seen state of *nodename*."""
+        return self._states[nodename][0]
+
+    def get_times(self, nodename):
+        """Return a dictionary with the time spent by *nodename* in each
+        state, including the time so far in the current state."""
+        times = dict(self._times.get(nodename, {}))
+        if nodename in self._states:
+            state, since = self._states[nodename]
+            times[state] = times.get(state, 0) + time.time() - since
+        return times
+
+    def wait(self, ready, timeout=1200, callback=None):
+        """Wait until ``ready(vm)`` is true for all VMs and return the
+        application. The *callback* is called for every transition."""
+        end_time = time.time() + timeout
+        delay = self.min_delay
+        with trace.span('watch') as sp:
+            transitions = []
+            if self.app is None:
+                transitions = self.poll()
+            while True:
+                for name, old, new in transitions:
+                    if old is not None:
+                        LOG.debug('Node `{}` changed state from `{}` to `{}`.'
+                                        .format(name, old, new))
+                    if callback:
+                        callback(name, old, new)
+                pending = [vm for vm in ravello.get_vms(self.app)
+                           if vm['name'] in self._states and not ready(vm)]
+                if not pending:
+                    break
+                if time.time() > end_time:
+                    raise RuntimeError('Timeout waiting for node `{name}` in state `{state}`.'
+                                            .format(**pending[0]))
+                if any(old is not None for _, old, _ in transitions):
+                    delay = self.min_delay
+                loop_delay = min(delay * (0.5 + random.random()), end_time - time.time())
+                with trace.span('sleep'):
+                    time.sleep(max(0, loop_delay))
+                delay = min(self.max_delay, delay * self.backoff)
+                transitions = self.poll()
+            sp.set(polls=self.polls)
+        for name in sorted(self._states):
+            times = self.get_times(name)
+            LOG.debug('Node `{}` time in state: {}.'.format(name, ', '.join(
+                        '{} {:.1f}s'.format(state, t) for state, t in sorted(times.items()))))
+        return self.app
@@ -30,3 +30,8 @@ def checksdist():
        ' | sort > files.sdist'.format(**version_info))
     run('diff -u files.git files.sdist || true')
     run('rm files.git; rm files.sdist')
+
+
+@task
+def bench():
+    run('PYTHONPATH=lib python -mravstack.bench', echo=True)